@@ -5,9 +5,12 @@
 import base64
 import collections
 import hashlib
+import httplib
 import json
 import logging
 import pysphere
+import socket
+import time
 from pysphere.resources import VimService_services as VI
 
 # WARNING(2014-10-18): If you set this higher than 8 the
@@ -37,6 +40,13 @@ SYSTEM_CONFIGURATION_MAP = {
 
 NET_DEVICE_TYPES = ['VirtualE1000', 'VirtualVmxnet3']
 
+# A session that has not been used for this long is checked with a cheap
+# CurrentTime call before it is handed out again
+SESSION_PROBE_INTERVAL = 60
+# Delay between failed logins, doubled up to the max
+SESSION_RETRY_DELAY = 5
+SESSION_RETRY_MAX_DELAY = 300
+
 
 class Error(Exception):
   """Base exception class for this module."""
@@ -99,6 +109,87 @@ class NoHostsInDatacenterError(Error):
 class DatacenterNotFoundError(Error):
   """The specificed datacenter was not found."""
 
+class SessionUnavailableError(Error):
+  """Not logged in, and waiting before trying again."""
+
+
+def is_session_error(e):
+  """Return whether an exception means that the session has to be redone."""
+  if isinstance(e, (socket.error, httplib.HTTPException, IOError)):
+    return True
+  if isinstance(e, pysphere.VIException):
+    return ('NotAuthenticated' in str(e.fault) or
+            e.fault == pysphere.FaultTypes.NOT_CONNECTED)
+  return False
+
+
+class Session(object):
+  """A logged in pysphere session to an ESXi or vCenter, kept between uses.
+
+  Logging in and out of vCenter for every pass is slow and fills its session
+  manager, so the session is kept until it fails. server() logs in again
+  (waiting longer after every failure) when the session is gone, call
+  failed() with errors raised while using it.
+  """
+
+  def __init__(self, host, username, password):
+    self.host = host
+    self.username = username
+    self.password = password
+    self.viserver = None
+    self.last_used = 0
+    self.delay = 0
+    self.retry_at = 0
+
+  def server(self):
+    """Return a logged in VIServer."""
+    now = time.time()
+    if (self.viserver is not None and
+        now - self.last_used >= SESSION_PROBE_INTERVAL):
+      try:
+        alive = self.viserver.keep_session_alive()
+      except Exception as e:
+        if not is_session_error(e):
+          raise
+        alive = False
+      if not alive:
+        logging.info('Session to %s expired', self.host)
+        self.reset()
+
+    if self.viserver is None:
+      if now < self.retry_at:
+        raise SessionUnavailableError(
+            'Not logging in to %s again for %d seconds' % (
+                self.host, self.retry_at - now))
+      server = pysphere.VIServer()
+      try:
+        server.connect(self.host, self.username, self.password)
+      except:
+        self.delay = min(SESSION_RETRY_MAX_DELAY,
+                         max(SESSION_RETRY_DELAY, self.delay * 2))
+        self.retry_at = now + self.delay
+        raise
+      logging.info('Logged in to %s', self.host)
+      self.viserver = server
+      self.delay = 0
+    self.last_used = now
+    return self.viserver
+
+  def failed(self, e):
+    """Drop the session if e means it is no longer usable."""
+    if is_session_error(e):
+      logging.info('Session to %s failed: %s', self.host, e)
+      self.reset()
+
+  def reset(self):
+    if self.viserver is None:
+      return
+    try:
+      self.viserver.disconnect()
+    except Exception:
+      pass
+    self.viserver = None
+
 
 def _get_datacenter_props(server, datacenter):
   if datacenter is None:
@@ -683,15 +774,185 @@ def add_host_to_dvs(server, host, datacenter, switch, interface):
     raise CreateDvSwitchError(vi_task.get_error_message())
 
 
-def get_vm_by_name(server, name):
-  """Get VM by name."""
-  for path in server.get_registered_vms():
-    vm = server.get_vm_by_path(path)
-    if vm.properties.name == name:
-      return vm._mor
+def get_vm_by_name(server, name, inventory=None):
+  """Get VM by name, from a VmInventory of the server if given.
+
+  VMs the inventory has not seen yet (it is only as fresh as its last
+  update) are looked up on the server.
+  """
+  if inventory is not None:
+    vm = inventory.by_name.get(name)
+    if vm is not None:
+      return inventory.vms[vm]['mor']
+  contents = server._retrieve_properties_traversal(
+      property_names=('name', ), obj_type='VirtualMachine')
+  for obj in contents or []:
+    for prop in getattr(obj, 'PropSet', None) or []:
+      if prop.Val == name:
+        return obj.Obj
   return None
 
 
+def _vm_uuid(uuid):
+  """Return the uuid a VM reports in SMBIOS given its config.uuid."""
+  # vmx-12 and forward has problem with endian conv
+  # this reverses in step of 2 the first 3 strings in the uuid
+  # AABBCCDD -> DDCCBBAA
+  luuid = uuid.lower().split('-')
+  l = []
+  for u in luuid[0:3]:
+    l.append(''.join([u[i:i + 2] for i in range(0, len(u), 2)][::-1]))
+  return '{0}-{1}'.format('-'.join(l), '-'.join(luuid[3:]))
+
+
+class VmInventory(object):
+  """Live inventory of the VMs of a server, fed by property collector updates.
+
+  A property filter over a container view of all VMs is created once, after
+  that update() only transfers what changed since the last version
+  (WaitForUpdatesEx). The VMs are kept by managed object id in 'vms' as
+  dicts with the keys of VM_PROPERTIES plus 'mor', and are indexed by name,
+  uuid (as reported by the VM, see _vm_uuid) and path.
+
+  The filter belongs to the session of the server, create a new inventory
+  when logging in again.
+  """
+
+  # Property path -> key in the VM dicts
+  VM_PROPERTIES = {
+    'name': 'name',
+    'config.uuid': 'uuid',
+    'config.files.vmPathName': 'path',
+    'runtime.powerState': 'power',
+    'network': 'networks',
+  }
+
+  def __init__(self, server):
+    self.server = server
+    self.version = ''
+    self.vms = {}
+    self.by_name = {}
+    self.by_uuid = {}
+    self.by_path = {}
+    self.collector = self._create_collector()
+    self._create_filter()
+
+  def _this(self, request, mor, mor_type):
+    _this = request.new__this(mor)
+    _this.set_attribute_type(mor_type)
+    request.set_element__this(_this)
+
+  def _create_collector(self):
+    # A collector of our own, so that the versions are not mixed up with
+    # other users of the session
+    request = VI.CreatePropertyCollectorRequestMsg()
+    self._this(request, self.server._do_service_content.PropertyCollector,
+               pysphere.MORTypes.PropertyCollector)
+    return self.server._proxy.CreatePropertyCollector(request)._returnval
+
+  def _create_filter(self):
+    content = self.server._do_service_content
+    request = VI.CreateContainerViewRequestMsg()
+    self._this(request, content.ViewManager, 'ViewManager')
+    container = request.new_container(content.RootFolder)
+    container.set_attribute_type(pysphere.MORTypes.Folder)
+    request.set_element_container(container)
+    request.set_element_type([pysphere.MORTypes.VirtualMachine])
+    request.set_element_recursive(True)
+    view = self.server._proxy.CreateContainerView(request)._returnval
+
+    request = VI.CreateFilterRequestMsg()
+    self._this(request, self.collector, pysphere.MORTypes.PropertyCollector)
+    spec = request.new_spec()
+    prop_set = spec.new_propSet()
+    prop_set.set_element_type(pysphere.MORTypes.VirtualMachine)
+    prop_set.set_element_pathSet(sorted(self.VM_PROPERTIES))
+    obj_set = spec.new_objectSet()
+    obj = obj_set.new_obj(view)
+    obj.set_attribute_type(pysphere.MORTypes.ContainerView)
+    obj_set.set_element_obj(obj)
+    obj_set.set_element_skip(True)
+    traversal = VI.ns0.TraversalSpec_Def('traverseView').pyclass()
+    traversal.set_element_name('traverseView')
+    traversal.set_element_type(pysphere.MORTypes.ContainerView)
+    traversal.set_element_path('view')
+    traversal.set_element_skip(False)
+    obj_set.set_element_selectSet([traversal])
+    spec.set_element_propSet([prop_set])
+    spec.set_element_objectSet([obj_set])
+    request.set_element_spec(spec)
+    request.set_element_partialUpdates(False)
+    self.server._proxy.CreateFilter(request)
+
+  def _wait(self):
+    request = VI.WaitForUpdatesExRequestMsg()
+    self._this(request, self.collector, pysphere.MORTypes.PropertyCollector)
+    request.set_element_version(self.version)
+    options = request.new_options()
+    # Return at once if nothing has changed
+    options.set_element_maxWaitSeconds(0)
+    request.set_element_options(options)
+    return self.server._proxy.WaitForUpdatesEx(request)._returnval
+
+  def _index(self, key, vm, add):
+    for index, field in ((self.by_name, 'name'), (self.by_uuid, 'uuid'),
+                         (self.by_path, 'path')):
+      value = vm.get(field)
+      if value is None:
+        continue
+      if add:
+        index[value] = key
+      elif index.get(value) == key:
+        del index[value]
+
+  def update(self):
+    """Apply the changes since the last update.
+
+    Returns (changed, removed): the ids of the VMs that were added or
+    changed, and the VMs that are gone by id.
+    """
+    changed = set()
+    removed = {}
+    while True:
+      update_set = self._wait()
+      if not update_set:
+        break
+      for filter_update in getattr(update_set, 'FilterSet', None) or []:
+        for obj_update in getattr(filter_update, 'ObjectSet', None) or []:
+          key = str(obj_update.Obj)
+          vm = self.vms.get(key)
+          if vm is not None:
+            self._index(key, vm, add=False)
+          if obj_update.Kind == 'leave':
+            if vm is not None:
+              removed[key] = self.vms.pop(key)
+            changed.discard(key)
+            continue
+          if vm is None:
+            vm = self.vms[key] = {'mor': pysphere.VIMor(
+                key, pysphere.MORTypes.VirtualMachine)}
+          for change in getattr(obj_update, 'ChangeSet', None) or []:
+            field = self.VM_PROPERTIES.get(change.Name)
+            if field is None:
+              continue
+            value = getattr(change, 'Val', None)
+            if change.Op in ('remove', 'indirectRemove'):
+              value = None
+            elif field == 'uuid' and value:
+              value = _vm_uuid(value)
+            elif field == 'networks':
+              value = sorted(str(n) for n in getattr(
+                  value, 'ManagedObjectReference', None) or [])
+            vm[field] = value
+          self._index(key, vm, add=True)
+          changed.add(key)
+      self.version = update_set.Version
+      # The rest of a large change follows right away
+      if not getattr(update_set, 'Truncated', False):
+        break
+    return changed, removed
+
+
 def get_vm_by_path(server, path):
   """Get VM by path."""
   return server.get_vm_by_path(path)._mor
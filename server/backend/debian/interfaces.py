@@ -2,22 +2,12 @@
 # Generate /etc/network/interfaces
 
 import os
+import sys
 import urlparse
 
 from lib import metadata
 
-first_if = None
-if 'QUERY_STRING' in os.environ:
-  query_string = urlparse.parse_qs(os.environ['QUERY_STRING'])
-  ifs = query_string['ifs'][0].split(',')
-  first_if = ifs[0]
-
-client, cm = metadata.find(os.environ['REMOTE_ADDR'], first_if)
-network = metadata.network(client, cm, )
-if not network:
-  exit(1)
-
-if_template = (
+BASE_TEMPLATE = (
 """# This file describes the network interfaces available on your system
 # and how to activate them. For more information, see interfaces(5).
 
@@ -28,16 +18,14 @@ auto lo
 iface lo inet loopback
 """)
 
-if network.bonded:
-  if client.os == 'debian':
-    if_template = if_template + """
+DEBIAN_BOND_TEMPLATE = """
 auto bond0
 iface bond0 inet manual
   bond-mode 802.3ad
   slaves eth0 eth1
 """
-  elif client.os == 'ubuntu':
-    if_template = if_template + """
+
+UBUNTU_BOND_TEMPLATE = """
 auto {if0}
 iface {if0} inet manual
   bond-master bond0
@@ -50,9 +38,9 @@ auto bond0
 iface bond0 inet manual
   bond-mode 802.3ad
   bond-slaves none
-""".format(if0=ifs[0], if1=ifs[1])
+"""
 
-if_template = if_template + """
+INTERFACE_TEMPLATE = """
 # The primary network interface
 auto {vlan_interface}
 iface {vlan_interface} inet static
@@ -66,7 +54,7 @@ iface {vlan_interface} inet6 static
 	gateway {v6_gateway}
 """
 
-vars_template = (
+VARS_TEMPLATE = (
 """v4_address={v4_address}
 v4_netmask={v4_netmask}
 v4_gateway={v4_gateway}
@@ -77,13 +65,42 @@ interface={interface}
 vlan_interface={vlan_interface}
 vlan={vlan}""")
 
-template = (vars_template if 'vars' in os.environ['QUERY_STRING']
-            else if_template)
-print ''
-print template.format(
-    v4_address=network.v4_address, v4_netmask=network.v4_netmask,
-    v4_gateway=network.v4_gateway, v6_address=network.v6_address,
-    v6_netmask=network.v6_netmask, v6_gateway=network.v6_gateway,
-    interface=network.interface, vlan_interface=network.vlan_interface,
-    vlan=network.vlan)
 
+def render(environ):
+  first_if = None
+  ifs = None
+  query_string = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+  if 'ifs' in query_string:
+    ifs = query_string['ifs'][0].split(',')
+    first_if = ifs[0]
+
+  client, cm = metadata.find(environ['REMOTE_ADDR'], first_if)
+  network = metadata.network(client, cm, )
+  if not network:
+    return None
+
+  if_template = BASE_TEMPLATE
+  if network.bonded:
+    if client.os == 'debian':
+      if_template = if_template + DEBIAN_BOND_TEMPLATE
+    elif client.os == 'ubuntu':
+      if_template = if_template + UBUNTU_BOND_TEMPLATE.format(
+          if0=ifs[0], if1=ifs[1])
+  if_template = if_template + INTERFACE_TEMPLATE
+
+  template = (VARS_TEMPLATE if 'vars' in environ.get('QUERY_STRING', '')
+              else if_template)
+  return template.format(
+      v4_address=network.v4_address, v4_netmask=network.v4_netmask,
+      v4_gateway=network.v4_gateway, v6_address=network.v6_address,
+      v6_netmask=network.v6_netmask, v6_gateway=network.v6_gateway,
+      interface=network.interface, vlan_interface=network.vlan_interface,
+      vlan=network.vlan) + '\n'
+
+
+if __name__ == '__main__':
+  output = render(os.environ)
+  if output is None:
+    exit(1)
+  print ''
+  sys.stdout.write(output)
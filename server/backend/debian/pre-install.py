@@ -1,10 +1,14 @@
 #!/usr/bin/env python2
 # This is a python script that produces a shell script, nifty huh? :)
 
-# Terminate headers here
-print ''
+import base64
+import os
+import sys
+
+from lib import escrow
+from lib import metadata
 
-print """
+HEADER = """
 #!/bin/sh
 #
 # Dreamhack overrides for Debian Installer
@@ -45,60 +49,7 @@ sed -i 's/Port 22/Port 2022/' /etc/ssh/sshd_config
 #echo 1 > /proc/sys/net/ipv6/conf/eth0."$vlan"/autoconf
 """
 
-import base64
-import hvac
-import os
-import socket
-import yaml
-
-from lib import metadata
-
-
-def vault(host):
-  fqdn = socket.getfqdn()
-  cert = '/var/lib/puppet/ssl/certs/%s.pem' % fqdn
-  key = '/var/lib/puppet/ssl/private_keys/%s.pem' % fqdn
-  client = hvac.Client(url=host, cert=(cert, key))
-  client.auth_tls()
-  return client
-
-# Move the secrets out of the directory that is kept in SVN
-config = yaml.safe_load(file('/etc/deploy.yaml'))
-client, _ = metadata.find(os.environ['REMOTE_ADDR'])
-
-# Only enable crypto disks on event machines
-is_event = client.domain == 'EVENT'
-crypto = is_event
-auto_unlock = True
-
-blacklist = '01liIoO='
-root_pw = base64.b64encode(os.urandom(11)).translate(None, blacklist)
-
-if is_event:
-  vault_path = 'services-{event}/login:{hostname}'
-else:
-  vault_path = 'services/login:{hostname}'
-
-vault(config['vault-host']).write(
-        vault_path.format(
-            hostname=client.hostname,
-            event=metadata.get_current_event()),
-        root_password=root_pw)
-
-print 'ROOTPW="%s"' % root_pw
-
-# Disable crypto on machines we know are co-location machines
-if not crypto:
-  print 'DO_CRYPTO=""'
-else:
-  passphrase = base64.b64encode(os.urandom(32))
-  print 'DO_CRYPTO="true"'
-  print 'PASSPHRASE="%s"' % passphrase
-  if auto_unlock:
-    print '# Save the passphrase for later if we want automatic unlock'
-    print 'echo -n "$PASSPHRASE" > /tmp/crypto.pass'
-
-print """
+FOOTER = """
 echo "d-i passwd/root-password password $ROOTPW" > conf.input
 echo "d-i passwd/root-password-again password $ROOTPW" >> conf.input
 echo "d-i network-console/password password $ROOTPW" >> conf.input
@@ -177,3 +128,48 @@ rm $0
 
 exit 0
 """
+
+def render(environ):
+  client, _ = metadata.find(environ['REMOTE_ADDR'])
+
+  # Only enable crypto disks on event machines
+  is_event = client.domain == 'EVENT'
+  crypto = is_event
+  auto_unlock = True
+
+  blacklist = '01liIoO='
+  root_pw = base64.b64encode(os.urandom(11)).translate(None, blacklist)
+
+  if is_event:
+    vault_path = 'services-{event}/login:{hostname}'
+  else:
+    vault_path = 'services/login:{hostname}'
+
+  # Written to Vault in the background, so that a slow Vault does not hold
+  # up the installer
+  escrow.submit(client.hostname, vault_path.format(
+      hostname=client.hostname, event=metadata.get_current_event()),
+      root_password=root_pw)
+
+  out = [HEADER]
+  out.append('ROOTPW="%s"' % root_pw)
+
+  # Disable crypto on machines we know are co-location machines
+  if not crypto:
+    out.append('DO_CRYPTO=""')
+  else:
+    passphrase = base64.b64encode(os.urandom(32))
+    out.append('DO_CRYPTO="true"')
+    out.append('PASSPHRASE="%s"' % passphrase)
+    if auto_unlock:
+      out.append('# Save the passphrase for later if we want automatic unlock')
+      out.append('echo -n "$PASSPHRASE" > /tmp/crypto.pass')
+
+  out.append(FOOTER)
+  return '\n'.join(out) + '\n'
+
+
+if __name__ == '__main__':
+  # Terminate headers here
+  print ''
+  sys.stdout.write(render(os.environ))
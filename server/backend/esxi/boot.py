@@ -1,26 +1,49 @@
 #!/usr/bin/env python2
 
 import os
+import sys
 import urlparse
 
 from lib import metadata
+from lib import templates
 
+# boot.cfg lives next to this script in the document root
+BOOT_CFG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'esxi', 'boot.cfg')
 
-query_string = urlparse.parse_qs(os.environ['QUERY_STRING'])
-ip = query_string['ip'][0]
-#client = metadata.lookup_ip(ip)
-client, cm = metadata.find(ip)
-network = metadata.network(client, cm)
 
-print ''
-with open('esxi/boot.cfg') as file:
-  for line in file:
+def compile_boot_cfg(contents):
+  """Turn boot.cfg into a format string taking the kernel options."""
+  out = []
+  for line in contents.splitlines(True):
+    line = line.replace('{', '{{').replace('}', '}}')
     if line.startswith('kernelopt='):
-      print line.rstrip() + " vlanid=%s ip=%s netmask=%s gateway=%s nameserver=8.8.8.8" % (network.vlan, network.v4_address, network.v4_netmask, network.v4_gateway)
+      out.append(line.rstrip() + ' {options}')
     else:
-      print line
+      out.append(line)
+  return '\n'.join(out) + '\n' if out else ''
 
-#print "vlanid=%s" % network.vlan
-#print "ip=%s" % network.v4_address
-#print "netmask=%s" % network.v4_netmask
-#print "gateway=%s" % network.v4_gateway
+
+def boot_cfg(vlan, v4_address, v4_netmask, v4_gateway):
+  template = templates.load(BOOT_CFG, compile_boot_cfg)
+  return template.format(options="vlanid=%s ip=%s netmask=%s gateway=%s nameserver=8.8.8.8" % (vlan, v4_address, v4_netmask, v4_gateway))
+
+
+def render(environ):
+  query_string = urlparse.parse_qs(environ['QUERY_STRING'])
+  ip = query_string['ip'][0]
+  #client = metadata.lookup_ip(ip)
+  client, cm = metadata.find(ip)
+  network = metadata.network(client, cm)
+
+  #print "vlanid=%s" % network.vlan
+  #print "ip=%s" % network.v4_address
+  #print "netmask=%s" % network.v4_netmask
+  #print "gateway=%s" % network.v4_gateway
+  return boot_cfg(network.vlan, network.v4_address, network.v4_netmask,
+                  network.v4_gateway)
+
+
+if __name__ == '__main__':
+  print ''
+  sys.stdout.write(render(os.environ))
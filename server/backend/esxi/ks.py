@@ -1,34 +1,52 @@
 #!/usr/bin/env python2
 import os
-import yaml
+import sys
 
+from lib import ipplan
 from lib import metadata
+from lib import templates
 
-# Move the secrets out of the directory that is kept in SVN
-config = yaml.safe_load(file('/etc/deploy.yaml'))
+# deploy-esx.template lives next to this script
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'deploy-esx.template')
 
-client, cm = metadata.find(os.environ['REMOTE_ADDR'])
-network = metadata.network(client, cm)
 
-if not network:
-  # No network info, default to manual installation
-  print ''
-  exit(0)
+# Portgroup commands by domain, for the ipplan index they were made from
+_portgroups = {}
+_portgroups_index = None
 
 
 def networkname(network, vlan):
     return '%s: %s' % (vlan, network.split('@', 1)[1])
 
 
+def portgroups(domain):
+  """Return the commands adding a portgroup for every network in a domain."""
+  global _portgroups, _portgroups_index
+  idx = ipplan.index()
+  if idx is not _portgroups_index:
+    _portgroups, _portgroups_index = {}, idx
+  if domain not in _portgroups:
+    out = []
+    for network, vlan in idx.vlans_in_domain(domain):
+      name = networkname(network, vlan)
+      out.append("""
+esxcli network vswitch standard portgroup add -v=vSwitch0 -p="{name}"
+esxcli network vswitch standard portgroup set -p="{name}" -v={vlan}
+""".format(name=name, vlan=vlan).strip())
+    _portgroups[domain] = out
+  return _portgroups[domain]
+
+
 def deploy_vm(hostname):
     network, vlan = metadata.get_vlan(hostname)
     if network is None:
       raise Exception('Unknown host %s' % hostname)
     name = networkname(network, vlan)
-    vmx = file('deploy-esx.template').read().format(
+    vmx = templates.load(TEMPLATE).format(
             hostname=hostname, network=name)
     # Create provisioning VMX
-    print """
+    return """
 mkdir /vmfs/volumes/datastore1/{hostname}/
 cat << _EOF_ > /vmfs/volumes/datastore1/{hostname}/vm.vmx
 {vmx}
@@ -38,21 +56,25 @@ ID=$(vim-cmd solo/registervm /vmfs/volumes/datastore1/{hostname}/vm.vmx)
 vim-cmd vmsvc/power.on $ID
 """.format(vmx=vmx, hostname=hostname)
 
-print ''
-print """
+
+def kickstart(hostname, v4_address, v4_netmask, v4_gateway, vlan):
+  # Move the secrets out of the directory that is kept in SVN
+  config = metadata.config('/etc/deploy.yaml')
+
+  out = ['']
+  out.append("""
 vmaccepteula
 rootpw {rootpw}
 install --firstdisk --overwritevmfs
 network --bootproto=static --ip={ipaddr} --netmask={netmask} --gateway={gateway} --nameserver=8.8.8.8 --vlanid={vlan} --addvmportgroup=false
 reboot
 """.format(
-        ipaddr=network.v4_address, netmask=network.v4_netmask,
-        gateway=network.v4_gateway, vlan=network.vlan,
-        rootpw=config['root-password'])
+          ipaddr=v4_address, netmask=v4_netmask, gateway=v4_gateway,
+          vlan=vlan, rootpw=config['root-password']))
 
-# First-boot script
-# TODO(bluecmd): Replace with dhtech CA certs
-print """
+  # First-boot script
+  # TODO(bluecmd): Replace with dhtech CA certs
+  out.append("""
 %firstboot --interpreter=busybox
 esxcli network ip interface ipv4 set --interface-name=vmk0 --ipv4={ipaddr} --netmask={netmask} --type=static
 esxcli network ip dns server add 8.8.8.8
@@ -63,23 +85,18 @@ esxcfg-route -a default {gateway}
 
 esxcli network vswitch standard portgroup add -v=vSwitch0 -p=deploy
 esxcli network vswitch standard portgroup set -p=deploy -v=4095
-""".format(ipaddr=network.v4_address, netmask=network.v4_netmask,
-           gateway=network.v4_gateway, hostname=client.hostname,
-           vlan=network.vlan)
+""".format(ipaddr=v4_address, netmask=v4_netmask, gateway=v4_gateway,
+             hostname=hostname, vlan=vlan))
 
-deploy_iter = metadata.get_deploy(client.hostname)
+  deploy_iter = metadata.get_deploy(hostname)
 
-# Add all VLANs if we're deploying
-if deploy_iter:
-  for network, vlan in metadata.all_vlans_in_same_domain(client.hostname):
-      name = networkname(network, vlan)
-      print """
-esxcli network vswitch standard portgroup add -v=vSwitch0 -p="{name}"
-esxcli network vswitch standard portgroup set -p="{name}" -v={vlan}
-""".format(name=name, vlan=vlan).strip()
+  # Add all VLANs if we're deploying
+  if deploy_iter:
+    my_net, _ = metadata.get_vlan(hostname)
+    out.extend(portgroups(my_net.split('@', 1)[0]))
 
-# Continuation of first-boot
-print """
+  # Continuation of first-boot
+  out.append("""
 rm /etc/vmware/ssl/rui.crt
 rm /etc/vmware/ssl/rui.key
 /sbin/generate-certificates
@@ -96,15 +113,34 @@ vim-cmd hostsvc/autostartmanager/update_defaults 20 20 no
 
 echo 'vmx.allowNested = "TRUE"' >> /etc/vmware/config
 echo 'hv.assumeEnabled = "TRUE"' >> /etc/vmware/config
-"""
+""")
 
-for host in deploy_iter:
-  deploy_vm(host)
+  for host in deploy_iter:
+    out.append(deploy_vm(host))
 
-# Post-install script
-# TODO(bluecmd): This seems to fail first install, but always succeed the second install
-# TODO(bluecmd): This probably doesn't like our CA
-print """
+  # Post-install script
+  # TODO(bluecmd): This seems to fail first install, but always succeed the
+  # second install
+  # TODO(bluecmd): This probably doesn't like our CA
+  out.append("""
 %post --interpreter=busybox --ignorefailure=true
 wget https://deploy.tech.dreamhack.se/provision.py
-""".format(hostname=client.hostname)
+""".format(hostname=hostname))
+  return '\n'.join(out) + '\n'
+
+
+def render(environ):
+  client, cm = metadata.find(environ['REMOTE_ADDR'])
+  network = metadata.network(client, cm)
+
+  if not network:
+    # No network info, default to manual installation
+    return ''
+
+  return kickstart(client.hostname, network.v4_address, network.v4_netmask,
+                   network.v4_gateway, network.vlan)
+
+
+if __name__ == '__main__':
+  print ''
+  sys.stdout.write(render(os.environ))
@@ -3,24 +3,29 @@
 import json
 import os
 import redis
+import sys
 from lib import metadata
+from lib import store
 
 
-# We should be using atomic operations here, but we ignore that since
-# the updates *should* be linear since it's only one machine accessing its own
-# records.
-client, cm = metadata.find(os.environ['REMOTE_ADDR'])
+def render(environ):
+  client, cm = metadata.find(environ['REMOTE_ADDR'])
 
-if not cm['installed']:
-  network = metadata.network(client, cm)
+  provisioned = cm['provisioned']
+  if not cm['installed']:
+    network = metadata.network(client, cm)
 
-  # This will tell provisiond to provision for the machine if not already done
-  # and also tell ipxe.py to boot to disk as default
-  cm['installed'] = True
-  cm['client'] = client.__dict__
-  cm['network'] = network.__dict__ if network else None
+    # This will tell provisiond to provision for the machine if not already
+    # done and also tell ipxe.py to boot to disk as default.
+    # The transition is done atomically in Redis so that it cannot race with
+    # provisiond updating the same record.
+    provisioned = store.mark_installed(
+        metadata.connection(), client.hostname, client.__dict__,
+        network.__dict__ if network else None)
 
-  metadata.update(client, cm)
+  return 'provisioned: %s\n' % provisioned
 
-print ''
-print 'provisioned:', cm['provisioned']
+
+if __name__ == '__main__':
+  print ''
+  sys.stdout.write(render(os.environ))
@@ -7,11 +7,13 @@
 import json
 import os
 import redis
+import sys
 import syslog
 import urlparse
 import yaml
 
 from lib import metadata
+from lib import store
 
 
 def handle(contents):
@@ -23,38 +25,49 @@ def handle(contents):
       'serial': contents['serial'][0]
      }
 
-  request_json = None
+  request = None
   if 'vmware' in data['manufacturer'].lower():
-    keys = r.keys('vmware-*-' + data['uuid'].lower())
-    if not keys:
+    # VMs are named after the host
+    request = store.find_vm(r, data['uuid'])
+    if not request:
       return
-    key = keys[0]
-    request_json = r.get(key)
   else:
-    # If platform not known, use serial number
-    request_json = r.get('install-' + data['serial'].strip())
+    # Machines in a C7000 are indexed by serial and OCP machines by MAC,
+    # by the provisiond that manages them
+    identity = store.get_identity(r, 'serial', data['serial'].strip())
+    if identity is None and 'mac' in contents:
+      identity = store.get_identity(r, 'mac', contents['mac'][0])
+    if identity and identity['order']:
+      request_json = r.get(identity['order'])
+      if request_json:
+        request = json.loads(request_json)
 
   if 'hostname' in contents:
     hostname = contents['hostname'][0].lower()
-  elif request_json:
-    request = json.loads(request_json)
+  elif request:
     hostname = request['name']
   else:
     return
   return hostname
 
 
-query_string = urlparse.parse_qs(os.environ['QUERY_STRING'])
-hostname = handle(query_string)
+def render(environ):
+  query_string = urlparse.parse_qs(environ['QUERY_STRING'])
+  hostname = handle(query_string)
+
+  out = ['#!ipxe']
+  if hostname:
+    out.append('set hostname %s' % hostname)
+  else:
+    # TODO(bluecmd): Enable this to allow users to enter hostname on
+    # non-managed hosts
+    out.append('echo No hostname found, please enter hostname (FQDN):')
+    out.append('read hostname')
+
+  out.append('echo I am ${hostname}')
+  return '\n'.join(out) + '\n'
 
-print ''
-print '#!ipxe'
-if hostname:
-  print 'set hostname %s' % hostname
-else:
-  # TODO(bluecmd): Enable this to allow users to enter hostname on
-  # non-managed hosts
-  print 'echo No hostname found, please enter hostname (FQDN):'
-  print 'read hostname'
 
-print 'echo I am ${hostname}'
+if __name__ == '__main__':
+  print ''
+  sys.stdout.write(render(os.environ))
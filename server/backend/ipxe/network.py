@@ -2,33 +2,40 @@
 # Configure iPXE network to production network
 
 import os
+import sys
 import urlparse
 
 from lib import metadata
 
 
-query_string = urlparse.parse_qs(os.environ['QUERY_STRING'])
-hostname = query_string['hostname'][0]
-network = metadata.installation_network(hostname)
+def render(environ):
+  query_string = urlparse.parse_qs(environ['QUERY_STRING'])
+  hostname = query_string['hostname'][0]
+  network = metadata.installation_network(hostname)
 
-print ''
-print '#!ipxe'
-for key, value in network.iteritems():
-  print 'set', key, value
+  out = ['#!ipxe']
+  for key, value in network.iteritems():
+    out.append('set %s %s' % (key, value))
 
-if 'noset' not in query_string:
-  # Remove DHCP settings
-  print 'set net0/ip 0.0.0.0'
+  if 'noset' not in query_string:
+    # Remove DHCP settings
+    out.append('set net0/ip 0.0.0.0')
 
-  # Apply settings to iPXE
-  print 'vcreate --tag ${vlan} net0'
-  print 'set net0-${vlan}/ip ${v4_address}'
-  print 'set net0-${vlan}/netmask ${v4_netmask}'
-  print 'set net0-${vlan}/gateway ${v4_gateway}'
-else:
-  # HACK(bluecmd): Since bnx2 iPXE doesn't like VLAN, we need to provide a way to
-  # override IP in order to not screw the whole design up.
-  print 'echo HACK: No-set hack enabled, will not switch over to VLAN'
+    # Apply settings to iPXE
+    out.append('vcreate --tag ${vlan} net0')
+    out.append('set net0-${vlan}/ip ${v4_address}')
+    out.append('set net0-${vlan}/netmask ${v4_netmask}')
+    out.append('set net0-${vlan}/gateway ${v4_gateway}')
+  else:
+    # HACK(bluecmd): Since bnx2 iPXE doesn't like VLAN, we need to provide a way
+    # to override IP in order to not screw the whole design up.
+    out.append('echo HACK: No-set hack enabled, will not switch over to VLAN')
 
-print 'echo My IP is ${v4_address} on VLAN ${vlan}'
-print 'sleep 3'
+  out.append('echo My IP is ${v4_address} on VLAN ${vlan}')
+  out.append('sleep 3')
+  return '\n'.join(out) + '\n'
+
+
+if __name__ == '__main__':
+  print ''
+  sys.stdout.write(render(os.environ))
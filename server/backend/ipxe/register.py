@@ -3,10 +3,12 @@
 
 import json
 import os
+import sys
 import syslog
 import urlparse
 
 from lib import metadata
+from lib import store
 
 
 def handle(ip, contents):
@@ -29,22 +31,31 @@ def handle(ip, contents):
      }
 
   hostname = metadata.lookup_ip(ip)
-  data_str = json.dumps(data)
+  # The domain is only used to filter hosts on the dashboard
+  network, _ = metadata.get_vlan(hostname)
+  data['domain'] = network.split('@', 1)[0] if network else None
   syslog.syslog(syslog.LOG_INFO,
-      'Registered metadata for %s: %s' % (hostname, data_str))
-  r.setex('host-' + hostname, 3600, data_str)
-  r.delete('last-log-' + hostname)
+      'Registered metadata for %s: %s' % (hostname, json.dumps(data)))
+  store.register_host(r, hostname, data)
+  # Logs of an earlier installation, see syslog-receiver
+  r.delete('last-log-' + hostname, 'log-' + hostname, 'phases-' + hostname)
   return hostname
 
-ip = os.environ['REMOTE_ADDR']
-query_string = urlparse.parse_qs(os.environ['QUERY_STRING'])
-# HACK(bluecmd): Since bnx2 iPXE doesn't like VLAN, we need to provide a way to
-# override IP in order to not screw the whole design up.
-if 'hack_ip' in query_string:
-  ip = query_string['hack_ip'][0]
 
-handle(ip, query_string)
+def render(environ):
+  ip = environ['REMOTE_ADDR']
+  query_string = urlparse.parse_qs(environ['QUERY_STRING'])
+  # HACK(bluecmd): Since bnx2 iPXE doesn't like VLAN, we need to provide a way
+  # to override IP in order to not screw the whole design up.
+  if 'hack_ip' in query_string:
+    ip = query_string['hack_ip'][0]
 
-# We need to present a dummy iPXE script to continue the boot process
-print ''
-print '#!ipxe'
+  handle(ip, query_string)
+
+  # We need to present a dummy iPXE script to continue the boot process
+  return '#!ipxe\n'
+
+
+if __name__ == '__main__':
+  print ''
+  sys.stdout.write(render(os.environ))
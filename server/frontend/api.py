@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+# JSON API for the state of installs, VM orders, VMs and bays.
+#
+# Parameters:
+#   table   one of hosts, vm-orders, install-orders, vms, bays
+#   manager, domain, state, error
+#           only return rows matching the value (error is 1 or 0)
+#   fields  comma separated list of fields to return
+#   limit   number of rows to return, at most MAX_LIMIT
+#   cursor  "next" from the previous page
+#
+# Served from the indexes kept by the dashboard aggregator.
+import cgi
+import json
+import sys
+
+from dhdeploy import dashboard
+from dhdeploy import metadata
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def reply(status, data):
+  print 'Status: %s' % status
+  print 'Content-Type: application/json'
+  print 'Cache-Control: no-cache'
+  print ''
+  sys.stdout.write(json.dumps(data))
+
+
+if __name__ == '__main__':
+  form = cgi.FieldStorage()
+  filters = {}
+  for field in dashboard.FILTERS:
+    value = form.getfirst(field)
+    if value is not None:
+      filters[field] = value
+  fields = form.getfirst('fields')
+  fields = fields.split(',') if fields else None
+
+  r = metadata.connection()
+  version, _ = dashboard.published(r)
+  if version is None:
+    reply('503 Service Unavailable', {'error': 'Dashboard not published'})
+    sys.exit(0)
+
+  try:
+    limit = min(int(form.getfirst('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    if limit < 1:
+      raise ValueError('limit must be positive')
+    items, cursor = dashboard.query(
+        r, form.getfirst('table'), filters, form.getfirst('cursor'), limit,
+        fields)
+  except (ValueError, dashboard.Error) as e:
+    reply('400 Bad Request', {'error': str(e)})
+    sys.exit(0)
+
+  reply('200 OK', {'items': items, 'next': cursor, 'version': version})
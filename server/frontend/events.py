@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+# Streams changes to the dashboard as Server-Sent Events.
+# The page passes the version it shows, every event carries the rows that
+# changed in the next version. Versions the page has missed are replayed from
+# the changes kept by the aggregator, only if they are no longer kept is the
+# page told to reload.
+import cgi
+import os
+import sys
+
+from dhdeploy import dashboard
+from dhdeploy import metadata
+
+# Send a comment this often to keep the connection from timing out
+KEEPALIVE = 15
+
+
+def send(event, version, data):
+  sys.stdout.write('id: %d\nevent: %s\ndata: %s\n\n' % (version, event, data))
+  sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  r = metadata.connection()
+  current, _ = dashboard.published(r)
+
+  # Browsers send the last seen id when reconnecting
+  version = os.environ.get('HTTP_LAST_EVENT_ID')
+  if not version:
+    version = cgi.FieldStorage().getfirst('version')
+
+  print 'Content-Type: text/event-stream'
+  print 'Cache-Control: no-cache'
+  print ''
+  sys.stdout.flush()
+
+  try:
+    version = int(version)
+    if current is None or version > current:
+      send('reload', current or 0, '{}')
+      sys.exit(0)
+
+    while True:
+      changes = dashboard.deltas(r, version, KEEPALIVE)
+      if not changes:
+        sys.stdout.write(': keepalive\n\n')
+        sys.stdout.flush()
+        continue
+      for version, delta in changes:
+        send('delta', version, delta)
+  except dashboard.VersionGoneError:
+    send('reload', dashboard.published(r)[0] or 0, '{}')
+  except (TypeError, ValueError):
+    # No or bad version from the page
+    send('reload', current or 0, '{}')
+  except IOError:
+    # The viewer went away
+    pass
@@ -1,13 +1,78 @@
 #!/usr/bin/env python2
-import collections
-import json
+import os
+import sys
+import time
 
+from dhdeploy import dashboard
 from dhdeploy import metadata
+from dhdeploy import views
 
+# Patches the tables with the rows sent by events.py as they change, and
+# counts down the TTLs
+LIVE_SCRIPT = '''
+<script>
+(function() {
+  if (!window.EventSource) {
+    setTimeout(function() { location.reload(); }, 5000);
+    return;
+  }
+  var source = new EventSource('events.py?version=%d');
+  source.addEventListener('delta', function(e) {
+    JSON.parse(e.data).changes.forEach(function(change) {
+      var old = document.getElementById(change.id);
+      if (change.html === null) {
+        if (old) old.parentNode.removeChild(old);
+        return;
+      }
+      var parent = document.createElement(
+          change.table == 'bays' ? 'div' : 'tbody');
+      parent.innerHTML = change.html;
+      var row = parent.firstElementChild;
+      if (old) {
+        old.parentNode.replaceChild(row, old);
+      } else {
+        var table = document.getElementById(change.table);
+        (table.tBodies ? table.tBodies[0] : table).appendChild(row);
+      }
+    });
+  });
+  source.addEventListener('reload', function() { location.reload(); });
+  setInterval(function() {
+    var cells = document.querySelectorAll('td.ttl');
+    for (var i = 0; i < cells.length; i++) {
+      var ttl = parseInt(cells[i].getAttribute('data-ttl'), 10) - 1;
+      cells[i].setAttribute('data-ttl', ttl);
+      cells[i].textContent = ttl;
+    }
+  }, 1000);
+})();
+</script>
+'''
+
+
+r = metadata.connection()
 
-store = metadata.connection()
+# Use the state published by the aggregator if it is running
+version, state = dashboard.published(r)
+if state is None:
+  etag = None
+  state = dashboard.snapshot(r)
+else:
+  # TTLs are rendered at request time, let them go stale for at most a minute
+  etag = '"%d-%d"' % (version, time.time() // 60)
+  if_none_match = os.environ.get('HTTP_IF_NONE_MATCH', '')
+  if etag in [x.strip() for x in if_none_match.split(',')]:
+    print 'Status: 304 Not Modified'
+    print 'ETag: %s' % etag
+    print ''
+    sys.exit(0)
+
+now = time.time()
 
 print 'Content-Type: text/html'
+if etag is not None:
+  print 'ETag: %s' % etag
+  print 'Cache-Control: no-cache'
 print ''
 print '<html>'
 print '''
@@ -15,8 +80,13 @@ print '''
 <title>remote deploy server</title>
 <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" integrity="sha384-1q8mTJOASx8j1Au+a5WDVnPi2lkFfwwEAa8hDDdjZlpLegxhjVME1fgjWPGmkzs7" crossorigin="anonymous">
 <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap-theme.min.css" integrity="sha384-fLW2N01lMqjakBkx3l/M9EahuwpSfeNvV63J5ezn3uZzapT0u7EYsXMjQV+0En5r" crossorigin="anonymous">
-<meta http-equiv="refresh" content="5">
-</head>'''
+'''
+if version is None:
+  print '<meta http-equiv="refresh" content="5">'
+else:
+  # Without JavaScript there are no live updates, fall back to reloading
+  print '<noscript><meta http-equiv="refresh" content="5"></noscript>'
+print '</head>'
 
 print '<body style="padding-top: 50px;">'
 print '''
@@ -31,72 +101,43 @@ print '''
 print '<div class="container">'
 
 print '<h2>Current Installs</h2>'
-print '<table class="table">'
-print '<tr><th>Host</th><th>Product</th><th width="50%">State</th><th>TTL</th></tr>'
-for i in store.keys('host-*'):
-  props = json.loads(store.get(i))
-  hostname = i.split('-', 1)[1]
-  last_log = store.get('last-log-' + hostname)
-  state_cls = 'info'
-  if props['installed']:
-    if props['provisioned']:
-      state = 'Done'
-      state_cls = ''
-    else:
-      state = 'Waiting for provision'
-  elif last_log:
-    state = 'Log: ' + last_log
-  else:
-    state = 'Starting installation'
-  print '<tr class="%s"><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-          state_cls, hostname, props['product'], state, store.ttl(i))
+print '<table class="table" id="hosts">'
+print '<tr><th>Host</th><th>Product</th><th width="50%">State</th><th>Escrow</th><th>TTL</th></tr>'
+for host in state.hosts:
+  print views.host(host, now)
 print '</table>'
 
 
 print '<h2>Install Orders</h2>'
 print '<h3>VMware</h3>'
-print '<table class="table">'
+print '<table class="table" id="vm-orders">'
 print '<tr><th>Host</th><th>Destination</th><th>TTL</th></tr>'
-for i in store.keys('create-vm-*'):
-  props = json.loads(store.get(i))
-  print '<tr><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-          props['name'], props['manager'], store.ttl(i))
+for order in state.vm_orders:
+  print views.vm_order(order, now)
 print '</table>'
 
 print '<h3>Physical</h3>'
-print '<table class="table">'
+print '<table class="table" id="install-orders">'
 print '<tr><th>Host</th><th>Destination</th><th>Bay</th><th>TTL</th></tr>'
-for i in store.keys('install-*'):
-  props = json.loads(store.get(i))
-  print '<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-          props['name'], props['manager'], props['bay'], store.ttl(i))
+for order in state.install_orders:
+  print views.install_order(order, now)
 print '</table>'
 
 print '<h2>Known VMware hosts</h2>'
-print '<table class="table">'
+print '<table class="table" id="vms">'
 print '<tr><th>Host</th><th>Provisioner</th></tr>'
-vms = collections.defaultdict(list)
-for i in store.keys('vmware-*'):
-  provisioner = i.split('-')[1]
-  props = json.loads(store.get(i))
-  vms[provisioner].append(props)
-
-for provisioner in sorted(vms.keys()):
-  for props in vms[provisioner]:
-    print '<tr><td>%s</td><td>%s</td></tr>' % (props['name'], provisioner)
+for vm in state.vms:
+  print views.vm(vm, now)
 print '</table>'
 
 print '<h2>Known C7000 bays</h2>'
-for i in store.keys('bays-*'):
-  print '<h3>%s</h3>' % i.split('-', 1)[1]
-  print '<table class="table">'
-  bays = json.loads(store.get(i))
-  for bay in sorted(int(x) for x in bays.keys()):
-    props = bays[str(bay)]
-    serial = props['serial'] if props else ''
-    print '<tr><td>%s</td><td>%s</td></tr>' % (bay, serial)
-  print '</table>'
+print '<div id="bays">'
+for bays in state.bays:
+  print views.bays(bays, now)
+print '</div>'
 
 
 print '</div>'
+if version is not None:
+  print LIVE_SCRIPT % version
 print '</body></html>'
@@ -2,5 +2,14 @@
 
 ls -R /etc/apache2/
 ls /var/www/
+# Spool and key of the escrow worker, written to by pre-install.py
+install -d -o www-data -m 0700 /var/spool/deploy/escrow
+python -m dhdeploy.escrow --init
+chown www-data /etc/deploy/escrow.key
 /usr/sbin/apache2ctl start
+python -m dhdeploy.dashboard &
+python -m dhdeploy.escrow &
+if [ -x /var/www/prerender ]; then
+  /var/www/prerender --watch &
+fi
 tail -f /var/log/apache2/*.log
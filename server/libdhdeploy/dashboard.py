@@ -0,0 +1,473 @@
+"""State shown on the deploy dashboard.
+
+snapshot() gathers everything in two pipelined round trips to Redis however
+many records there are, one listing the family indexes and one fetching the
+records. The time a record expires is taken from its index score.
+
+Rather than every viewer doing that, the aggregator (run this module) keeps
+the state in memory, re-reads only the records Redis reports as changed
+through keyspace notifications and publishes the state to the 'dashboard'
+hash together with a version that is bumped when the state changes.
+published() returns it, so viewers can tell if they are up to date from the
+version alone. The aggregator also does a full resync every RESYNC_INTERVAL
+seconds, since notifications are not delivered while it is disconnected.
+
+Along with every new version the aggregator appends the rows that changed,
+rendered by views, to the DELTAS_KEY stream for live viewers. The entry of
+a version has the ID '<version>-0', and the last DELTAS_MAXLEN (about) are
+kept, so that a viewer can catch up from the version it shows, see deltas().
+
+For the JSON API the aggregator also keeps every row in ROWS_KEY and indexes
+them per table and per value of the FILTERS fields in lexically sorted sets,
+which query() intersects and pages through server side.
+
+VMs are read from the registry of their manager (see store.publish_vms), one
+record holding many rows, keyed '<registry>-<uuid>'.
+"""
+import collections
+import json
+import logging
+import time
+
+from . import metadata
+from . import store
+from . import views
+
+HOST_FIELDS = (
+  'installed', 'provisioned', 'product', 'domain', 'error', 'escrow')
+FAMILIES = ('host', 'create-vm', 'install', 'vmware', 'bays')
+
+DASHBOARD_KEY = 'dashboard'
+DELTAS_KEY = 'dashboard-deltas'
+DELTAS_MAXLEN = 1000
+ROWS_KEY = 'dashboard-rows'
+# Set of all index keys, to be able to start over
+INDEXES_KEY = 'dashboard-indexes'
+FILTERS = ('manager', 'domain', 'state', 'error')
+RESYNC_INTERVAL = 60
+# Changes arriving within this many seconds are published together
+BATCH_DELAY = 0.2
+
+Host = collections.namedtuple('Host', (
+  'key', 'name', 'product', 'domain', 'installed', 'provisioned', 'error',
+  'escrow', 'last_log', 'expires'))
+Order = collections.namedtuple('Order', (
+  'key', 'name', 'manager', 'bay', 'state', 'error', 'expires'))
+VM = collections.namedtuple('VM', ('key', 'name', 'provisioner'))
+Bays = collections.namedtuple('Bays', ('key', 'provisioner', 'bays'))
+State = collections.namedtuple('State', (
+  'hosts', 'vm_orders', 'install_orders', 'vms', 'bays'))
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class UnknownTableError(Error):
+  """There is no such table."""
+
+
+class UnknownFilterError(Error):
+  """The field cannot be filtered on."""
+
+
+class VersionGoneError(Error):
+  """The changes since a version are no longer kept."""
+
+
+def _family(key):
+  try:
+    return store.family(key)
+  except store.UnknownFamilyError:
+    return None
+
+
+def _fetch(r, keys):
+  """Read records in one pipeline, returns {key: row} of those that exist."""
+  pipe = r.pipeline(transaction=False)
+  for key in keys:
+    family = _family(key)
+    if family == 'host':
+      pipe.hmget(key, HOST_FIELDS)
+      pipe.get('last-log-' + key[len('host-'):])
+    elif family == 'vmware':
+      pipe.hgetall(key)
+    else:
+      pipe.get(key)
+    if family in ('host', 'create-vm', 'install'):
+      pipe.zscore(store.index_key(family), key)
+  results = iter(pipe.execute())
+
+  rows = {}
+  for key in keys:
+    family = _family(key)
+    if family == 'host':
+      values, last_log = next(results), next(results)
+      expires = next(results)
+      # Gone since it was listed
+      if all(v is None for v in values):
+        continue
+      props = store.decode_host(HOST_FIELDS, values)
+      rows[key] = Host(key, key[len('host-'):], props['product'],
+                       props['domain'], props['installed'],
+                       props['provisioned'], props['error'], props['escrow'],
+                       last_log, expires)
+      continue
+    if family == 'vmware':
+      manager = key[len('vmware-'):]
+      for uuid, value in next(results).iteritems():
+        vm_key = '%s-%s' % (key, uuid)
+        rows[vm_key] = VM(vm_key, json.loads(value)['name'], manager)
+      continue
+
+    value = next(results)
+    expires = next(results) if family in ('create-vm', 'install') else None
+    if value is None:
+      continue
+    props = json.loads(value)
+    if family in ('create-vm', 'install'):
+      if props.get('dead'):
+        state = 'dead'
+      elif props.get('initialized'):
+        state = 'done'
+      elif props.get('error'):
+        state = 'retrying'
+      else:
+        state = 'queued'
+      rows[key] = Order(key, props['name'], props['manager'], props.get('bay'),
+                        state, props.get('error'), expires)
+    elif family == 'bays':
+      rows[key] = Bays(key, key.split('-', 1)[1], props)
+  return rows
+
+
+def _list(r):
+  """Return the keys of all live records shown on the dashboard."""
+  now = time.time()
+  pipe = r.pipeline(transaction=False)
+  for family in FAMILIES:
+    pipe.zremrangebyscore(store.index_key(family), '-inf', now)
+    pipe.zrangebyscore(store.index_key(family), now, '+inf')
+  return [key for members in pipe.execute()[1::2] for key in members]
+
+
+def _state(rows):
+  """Build a State from {key: row}."""
+  by_family = collections.defaultdict(list)
+  for key, row in rows.iteritems():
+    by_family[_family(key)].append(row)
+  by_expiry = lambda row: (row.expires, row.name)
+  return State(
+      sorted(by_family['host'], key=by_expiry),
+      sorted(by_family['create-vm'], key=by_expiry),
+      sorted(by_family['install'], key=by_expiry),
+      sorted(by_family['vmware'], key=lambda vm: (vm.provisioner, vm.name)),
+      sorted(by_family['bays'], key=lambda bays: bays.provisioner))
+
+
+def snapshot(r):
+  """Return the current State, read from the records."""
+  return _state(_fetch(r, _list(r)))
+
+
+def _item(row):
+  """Return the API representation of a row."""
+  if isinstance(row, Host):
+    if row.error:
+      state = 'error'
+    elif row.installed:
+      state = 'done' if row.provisioned else 'provisioning'
+    else:
+      state = 'installing'
+    return {'name': row.name, 'product': row.product, 'domain': row.domain,
+            'state': state, 'error': row.error, 'escrow': row.escrow,
+            'last_log': row.last_log, 'expires': row.expires}
+  elif isinstance(row, Order):
+    item = {'name': row.name, 'manager': row.manager, 'state': row.state,
+            'error': row.error, 'expires': row.expires}
+    if row.bay is not None:
+      item['bay'] = row.bay
+    return item
+  elif isinstance(row, VM):
+    return {'name': row.name, 'manager': row.provisioner}
+  return {'manager': row.provisioner, 'bays': row.bays}
+
+
+def _table_index(table):
+  return 'dashboard-index-' + table
+
+
+def _filter_index(table, field, value):
+  return 'dashboard-index-%s-%s-%s' % (table, field, value)
+
+
+def _indexes(key, item):
+  """Return the index keys a row belongs to."""
+  if item is None:
+    return set()
+  table = views.TABLES[_family(key)]
+  indexes = set([_table_index(table)])
+  for field in FILTERS:
+    if field not in item:
+      continue
+    value = item[field]
+    if field == 'error':
+      value = 1 if value else 0
+    if value is not None:
+      indexes.add(_filter_index(table, field, value))
+  return indexes
+
+
+# Returns the next cursor (empty if this is the last page) and the rows.
+# The smallest index is walked from the cursor, keeping keys present in all
+# the other indexes.
+# KEYS: indexes to intersect, rows hash
+# ARGV: cursor (exclusive, empty to start from the beginning), page size
+_QUERY = store.Script("""
+local indexes = {}
+for i = 1, #KEYS - 1 do
+  table.insert(indexes, {KEYS[i], redis.call('ZCARD', KEYS[i])})
+end
+table.sort(indexes, function(a, b) return a[2] < b[2] end)
+local limit = tonumber(ARGV[2])
+local start = '-'
+if ARGV[1] ~= '' then
+  start = '(' .. ARGV[1]
+end
+local found = {}
+while #found <= limit do
+  local batch = redis.call('ZRANGEBYLEX', indexes[1][1], start, '+',
+                           'LIMIT', 0, 100)
+  if #batch == 0 then
+    break
+  end
+  for _, key in ipairs(batch) do
+    local member = true
+    for i = 2, #indexes do
+      if not redis.call('ZSCORE', indexes[i][1], key) then
+        member = false
+        break
+      end
+    end
+    if member then
+      table.insert(found, key)
+      if #found > limit then
+        break
+      end
+    end
+  end
+  start = '(' .. batch[#batch]
+end
+local cursor = ''
+if #found > limit then
+  table.remove(found)
+  cursor = found[#found]
+end
+local rows = {}
+for i, key in ipairs(found) do
+  rows[i] = redis.call('HGET', KEYS[#KEYS], key)
+end
+return {cursor, rows}
+""")
+
+
+def query(r, table, filters=None, cursor=None, limit=100, fields=None):
+  """Return a page of rows of a table as (items, next cursor).
+
+  filters maps FILTERS fields to the value to match, error matches 1 for rows
+  with an error and 0 for rows without. Only the given fields of the rows
+  are returned if fields is set. The cursor is None on the last page.
+  """
+  if table not in views.TABLES.values():
+    raise UnknownTableError('No table %s' % table)
+  indexes = [_table_index(table)]
+  for field, value in sorted((filters or {}).iteritems()):
+    if field not in FILTERS:
+      raise UnknownFilterError('Cannot filter on %s' % field)
+    indexes.append(_filter_index(table, field, value))
+  cursor, rows = _QUERY(
+      r, keys=indexes + [ROWS_KEY], args=[cursor or '', limit])
+  items = []
+  for row in rows:
+    # Removed while paging
+    if row is None:
+      continue
+    item = json.loads(row)
+    if fields:
+      item = {f: item.get(f) for f in fields}
+    items.append(item)
+  return items, cursor or None
+
+
+def _decode(state):
+  return State(
+      [Host(*x) for x in state[0]],
+      [Order(*x) for x in state[1]],
+      [Order(*x) for x in state[2]],
+      [VM(*x) for x in state[3]],
+      [Bays(*x) for x in state[4]])
+
+
+def published(r):
+  """Return (version, State) as published by the aggregator.
+
+  Returns (None, None) if the aggregator has not published anything.
+  """
+  version, state = r.hmget(DASHBOARD_KEY, ('version', 'state'))
+  if version is None or state is None:
+    return None, None
+  return int(version), _decode(json.loads(state))
+
+
+def deltas(r, version, timeout=None):
+  """Return the changes published after version, in order.
+
+  Returns a list of (version, JSON encoded changes), waiting up to timeout
+  seconds if there are none yet (not at all if timeout is None). Raises
+  VersionGoneError if the changes since version are no longer kept, the
+  viewer has to start over from the current state then.
+  """
+  block = int(timeout * 1000) if timeout is not None else None
+  response = r.xread({DELTAS_KEY: '%d-0' % version}, block=block)
+  result = []
+  for _, entries in response or []:
+    for entry_id, fields in entries:
+      result.append((int(entry_id.split('-', 1)[0]), fields['delta']))
+  if result and result[0][0] != version + 1:
+    raise VersionGoneError('Changes after version %d are gone' % version)
+  return result
+
+
+class Aggregator(object):
+  """Keeps the published dashboard State up to date."""
+
+  def __init__(self, r):
+    self.r = r
+    self.rows = {}
+    # Registry key -> keys of the VM rows read from it
+    self.registries = {}
+    self.published = None
+    self.version = None
+
+  def resync(self):
+    keys = set(_list(self.r)) | set(
+        key for key, row in self.rows.iteritems() if not isinstance(row, VM))
+    self.update(list(keys | set(self.registries)))
+
+  def reset(self):
+    """Drop the rows, indexes and changes of a previous run."""
+    pipe = self.r.pipeline()
+    pipe.delete(ROWS_KEY, DELTAS_KEY, *self.r.smembers(INDEXES_KEY))
+    pipe.delete(INDEXES_KEY)
+    pipe.execute()
+
+  def update(self, keys):
+    """Re-read records that have changed."""
+    rows = _fetch(self.r, keys)
+    # The VMs of a registry that changed, including those that are gone
+    vm_keys = set()
+    for key in keys:
+      if _family(key) != 'vmware':
+        continue
+      vm_keys.update(self.registries.pop(key, ()))
+      prefix = key + '-'
+      members = set(k for k in rows if k.startswith(prefix))
+      if members:
+        self.registries[key] = members
+      vm_keys.update(members)
+    changed = []
+    for key in list(keys) + sorted(vm_keys):
+      row = rows.get(key)
+      old = self.rows.get(key)
+      if row != old:
+        changed.append((key, old, row))
+      if row is not None:
+        self.rows[key] = row
+      else:
+        self.rows.pop(key, None)
+    self.publish(changed)
+
+  def publish(self, changed):
+    """Publish the state and the rows that changed if it is a new state."""
+    state = json.dumps(
+        _state(self.rows), separators=(',', ':'), sort_keys=True)
+    if state == self.published:
+      return
+    if self.version is None:
+      # Skip a version, so that viewers of the previous run start over
+      # rather than getting only the changes since it (see deltas())
+      self.version = int(self.r.hget(DASHBOARD_KEY, 'version') or 0) + 1
+    self.version += 1
+
+    now = time.time()
+    changes = []
+    pipe = self.r.pipeline()
+    for key, old, row in changed:
+      family = _family(key)
+      changes.append({
+          'id': key,
+          'table': views.TABLES[family],
+          'html': views.RENDER[family](row, now) if row else None,
+      })
+
+      item = _item(row) if row else None
+      old_indexes = _indexes(key, _item(old) if old else None)
+      new_indexes = _indexes(key, item)
+      for index in old_indexes - new_indexes:
+        pipe.zrem(index, key)
+      for index in new_indexes - old_indexes:
+        pipe.zadd(index, {key: 0})
+      if new_indexes - old_indexes:
+        pipe.sadd(INDEXES_KEY, *(new_indexes - old_indexes))
+      if item:
+        pipe.hset(ROWS_KEY, key, json.dumps(item))
+      else:
+        pipe.hdel(ROWS_KEY, key)
+
+    pipe.hmset(DASHBOARD_KEY, {'version': self.version, 'state': state})
+    pipe.xadd(DELTAS_KEY, {'delta': json.dumps(
+        {'version': self.version, 'changes': changes})},
+        id='%d-0' % self.version, maxlen=DELTAS_MAXLEN)
+    pipe.execute()
+    self.published = state
+    logging.info('Published dashboard version %d', self.version)
+
+  def run(self):
+    pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe(*['__keyspace@*__:%s-*' % family
+                        for family in FAMILIES + ('last-log', )])
+    self.reset()
+    last_resync = 0
+    while True:
+      if time.time() - last_resync >= RESYNC_INTERVAL:
+        self.resync()
+        last_resync = time.time()
+
+      message = pubsub.get_message(timeout=1)
+      if message is None:
+        continue
+      # Collect everything that changes close together
+      keys = set()
+      deadline = time.time() + BATCH_DELAY
+      while True:
+        if message is not None:
+          key = message['channel'].split(':', 1)[1]
+          # Log lines are shown with their host
+          if key.startswith('last-log-'):
+            key = store.host_key(key[len('last-log-'):])
+          keys.add(key)
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        message = pubsub.get_message(timeout=timeout)
+      self.update(list(keys))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  while True:
+    try:
+      Aggregator(metadata.connection()).run()
+    except Exception:
+      logging.exception('Aggregator failed, restarting')
+      time.sleep(1)
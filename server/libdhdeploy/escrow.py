@@ -0,0 +1,239 @@
+"""Escrow of generated secrets to Vault.
+
+Writing the root password of an installing host to Vault inside the request
+the installer waits on means that a slow Vault stalls every installation.
+Instead submit() stores the secret in SPOOL_DIR, encrypted with the key in
+KEY_FILE, and returns. The worker (python -m dhdeploy.escrow) writes the
+spooled secrets to Vault, oldest first, with one authenticated client that is
+kept between batches, and retries with backoff while Vault is unavailable.
+
+A secret Vault refuses (e.g. permission denied on its path) is retried on its
+own with backoff, counting the attempts in '.retry-<name>' next to it, and
+set aside as '.failed-<name>' after MAX_ATTEMPTS, so that it does not hold
+up the secrets spooled after it.
+
+The escrow state of a host ('pending' until written, then 'done', or 'failed'
+if given up) is kept in its record for the dashboard.
+"""
+import argparse
+import errno
+import json
+import logging
+import os
+import redis
+import socket
+import sys
+import tempfile
+import time
+
+from cryptography import fernet
+
+from . import metadata
+from . import store
+
+SPOOL_DIR = '/var/spool/deploy/escrow'
+KEY_FILE = '/etc/deploy/escrow.key'
+# Secrets written per batch, and the time to wait when the spool is empty
+BATCH_SIZE = 50
+POLL_INTERVAL = 1
+RETRY_DELAY = 5
+RETRY_MAX_DELAY = 300
+# Attempts at a secret Vault refuses before it is set aside
+MAX_ATTEMPTS = 10
+
+
+def _key():
+  """Return the spool encryption key, created on first use."""
+  try:
+    fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  else:
+    with os.fdopen(fd, 'w') as f:
+      f.write(fernet.Fernet.generate_key())
+  with open(KEY_FILE) as f:
+    return f.read().strip()
+
+
+def vault_client(host):
+  # Only the worker talks to Vault, submit() works without hvac
+  import hvac
+  fqdn = socket.getfqdn()
+  cert = '/var/lib/puppet/ssl/certs/%s.pem' % fqdn
+  key = '/var/lib/puppet/ssl/private_keys/%s.pem' % fqdn
+  client = hvac.Client(url=host, cert=(cert, key))
+  client.auth_tls()
+  return client
+
+
+def submit(hostname, path, **secrets):
+  """Queue secrets to be written to path in Vault for a host."""
+  entry = json.dumps({'hostname': hostname, 'path': path, 'secrets': secrets})
+  data = fernet.Fernet(_key()).encrypt(entry)
+  fd, tmp = tempfile.mkstemp(dir=SPOOL_DIR, prefix='.new-')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    # Names sort in submission order
+    os.rename(tmp, os.path.join(SPOOL_DIR, '%017.6f-%s' % (
+        time.time(), hostname)))
+  except:
+    os.unlink(tmp)
+    raise
+  dir_fd = os.open(SPOOL_DIR, os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)
+  finally:
+    os.close(dir_fd)
+  store.set_host_escrow(metadata.connection(), hostname, 'pending')
+
+
+def _remove(path):
+  try:
+    os.unlink(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+
+def pending():
+  """Return the names of the spooled secrets, oldest first."""
+  return sorted(n for n in os.listdir(SPOOL_DIR) if not n.startswith('.'))
+
+
+def unavailable(e):
+  """Return whether an error means Vault cannot take any secret right now.
+
+  That is failing to connect or log in, or Vault being down, as opposed to
+  Vault refusing one secret.
+  """
+  import hvac.exceptions
+  import requests
+  return isinstance(e, (
+      socket.error, requests.exceptions.RequestException,
+      hvac.exceptions.Unauthorized, hvac.exceptions.VaultDown,
+      hvac.exceptions.VaultNotInitialized,
+      hvac.exceptions.InternalServerError))
+
+
+class Worker(object):
+  """Writes spooled secrets to Vault."""
+
+  def __init__(self, host):
+    self.host = host
+    self.client = None
+
+  def vault(self):
+    # The token from the TLS login is reused until it expires
+    if self.client is None or not self.client.is_authenticated():
+      self.client = vault_client(self.host)
+    return self.client
+
+  def attempts(self, name):
+    """Return (attempts, time of the next attempt) of a spooled secret."""
+    try:
+      with open(os.path.join(SPOOL_DIR, '.retry-' + name)) as f:
+        retry = json.load(f)
+      return retry['attempts'], retry['next']
+    except (IOError, ValueError, KeyError):
+      return 0, 0
+
+  def refused(self, r, name, entry, attempts, e):
+    """Retry a secret Vault refused later, or set it aside."""
+    path = os.path.join(SPOOL_DIR, name)
+    retry = os.path.join(SPOOL_DIR, '.retry-' + name)
+    attempts += 1
+    if attempts < MAX_ATTEMPTS:
+      delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (attempts - 1))
+      logging.error('Vault refused secret %s for %s (attempt %d), '
+                    'retrying in %ds: %s', name, entry['hostname'],
+                    attempts, delay, e)
+      with open(retry, 'w') as f:
+        json.dump({'attempts': attempts, 'next': time.time() + delay}, f)
+      return
+    logging.error('Vault refused secret %s for %s %d times, setting it '
+                  'aside: %s', name, entry['hostname'], attempts, e)
+    os.rename(path, os.path.join(SPOOL_DIR, '.failed-' + name))
+    _remove(retry)
+    try:
+      store.set_host_escrow(r, entry['hostname'], 'failed')
+    except redis.RedisError:
+      logging.exception('Failed to mark %s not escrowed', entry['hostname'])
+
+  def flush(self):
+    """Write a batch of secrets, returns the number written.
+
+    Raises if Vault is unavailable, see unavailable().
+    """
+    crypto = fernet.Fernet(_key())
+    r = metadata.connection()
+    now = time.time()
+    tried = 0
+    written = 0
+    for name in pending():
+      if tried == BATCH_SIZE:
+        break
+      attempts, next_attempt = self.attempts(name)
+      if next_attempt > now:
+        continue
+      tried += 1
+      path = os.path.join(SPOOL_DIR, name)
+      with open(path) as f:
+        data = f.read()
+      try:
+        entry = json.loads(crypto.decrypt(data))
+      except (fernet.InvalidToken, ValueError):
+        logging.error('Cannot decrypt spooled secret %s, setting it aside',
+                      name)
+        os.rename(path, os.path.join(SPOOL_DIR, '.invalid-' + name))
+        continue
+      client = self.vault()
+      try:
+        client.write(entry['path'], **entry['secrets'])
+      except Exception as e:
+        if unavailable(e):
+          raise
+        self.refused(r, name, entry, attempts, e)
+        continue
+      os.unlink(path)
+      _remove(os.path.join(SPOOL_DIR, '.retry-' + name))
+      written += 1
+      try:
+        store.set_host_escrow(r, entry['hostname'], 'done')
+      except redis.RedisError:
+        logging.exception('Failed to mark %s escrowed', entry['hostname'])
+    return written
+
+  def run(self):
+    delay = 0
+    while True:
+      try:
+        written = self.flush()
+      except Exception:
+        logging.exception('Failed to escrow secrets')
+        # Log in again on the next attempt
+        self.client = None
+        delay = min(RETRY_MAX_DELAY, max(RETRY_DELAY, delay * 2))
+        time.sleep(delay)
+        continue
+      delay = 0
+      if written:
+        logging.info('Escrowed %d secrets', written)
+      if written < BATCH_SIZE:
+        time.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Write spooled secrets to Vault')
+  parser.add_argument('--init', action='store_true',
+      help='Only create the spool key if missing')
+  args = parser.parse_args()
+
+  if args.init:
+    _key()
+    sys.exit(0)
+  logging.basicConfig(level=logging.INFO)
+  Worker(metadata.config('/etc/deploy.yaml')['vault-host']).run()
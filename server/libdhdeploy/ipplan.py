@@ -0,0 +1,341 @@
+"""Read model of the ipplan database.
+
+Two interchangeable views are provided, both answering lookups without
+touching SQLite:
+
+ * Index loads host, network, option and meta_data from ipplan.db into dicts
+   keyed on hostname and IPv4 address. Meant for long-running processes.
+ * Snapshot memory-maps a compiled, read-only index file (ipplan.idx) with
+   sorted keys that are binary searched. Opening it is a couple of syscalls
+   and its pages are shared between processes, so it is meant for short-lived
+   processes (CGI scripts, command line tools).
+
+index() returns the snapshot when it exists and was compiled from the current
+ipplan.db, otherwise the in-memory Index, re-reading the database when it has
+been replaced or modified.
+
+Compile a snapshot after updating ipplan.db with:
+
+  python ipplan.py [--db /etc/ipplan/ipplan.db] [--output /etc/ipplan/ipplan.idx]
+"""
+import argparse
+import collections
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+
+DB_FILE = '/etc/ipplan/ipplan.db'
+
+# magic, source device, inode, mtime, size, number of sections
+_HEADER = struct.Struct('<8sQQdQI')
+# name, file offset of the record offset table, number of records
+_SECTION = struct.Struct('<8sQI')
+_OFFSET = struct.Struct('<I')
+MAGIC = 'IPPLIDX1'
+
+Host = collections.namedtuple('Host', (
+  'node_id', 'name', 'ipv4_addr', 'ipv6_addr', 'network_id'))
+Network = collections.namedtuple('Network', (
+  'node_id', 'name', 'vlan', 'ipv4_netmask', 'ipv4_netmask_dec',
+  'ipv4_gateway', 'ipv6_netmask', 'ipv6_gateway'))
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class SnapshotFormatError(Error):
+  """The snapshot file is not a valid compiled ipplan index."""
+
+
+class Index(object):
+  """Immutable in-memory copy of one version of ipplan.db."""
+
+  def __init__(self, conn):
+    self.hosts = {}
+    self.hosts_by_ip = {}
+    self.networks = {}
+    self.options = collections.defaultdict(
+        lambda: collections.defaultdict(list))
+    self.meta_data = {}
+
+    c = conn.cursor()
+    # Read all tables in one transaction to get a consistent view
+    c.execute('BEGIN')
+    c.execute('SELECT node_id, name, ipv4_addr_txt, ipv6_addr_txt, network_id '
+              'FROM host')
+    for row in c:
+      host = Host(*row)
+      self.hosts[host.name] = host
+      # If an address is listed twice, the first host wins like it did with
+      # the old SQL lookup
+      self.hosts_by_ip.setdefault(host.ipv4_addr, host.name)
+
+    c.execute('SELECT node_id, name, vlan, ipv4_netmask_txt, '
+              'ipv4_netmask_dec, ipv4_gateway_txt, ipv6_netmask_txt, '
+              'ipv6_gateway_txt FROM network')
+    for row in c:
+      network = Network(*row)
+      self.networks[network.node_id] = network
+
+    c.execute('SELECT node_id, name, value FROM option ORDER BY rowid')
+    for node_id, name, value in c:
+      self.options[node_id][name].append(value)
+
+    c.execute('SELECT name, value FROM meta_data')
+    for name, value in c:
+      self.meta_data.setdefault(name, value)
+    c.execute('COMMIT')
+
+    # Networks with VLANs grouped by domain (the part before the '@')
+    self.domain_vlans = collections.defaultdict(list)
+    for network in sorted(self.networks.itervalues(), key=lambda n: n.vlan):
+      if network.vlan == 0 or '@' not in network.name:
+        continue
+      domain, _ = network.name.split('@', 1)
+      self.domain_vlans[domain].append((network.name, network.vlan))
+
+  def lookup_ip(self, ip):
+    return self.hosts_by_ip.get(ip)
+
+  def host(self, hostname):
+    return self.hosts.get(hostname)
+
+  def network(self, hostname):
+    """Return the network the host is in, or None."""
+    host = self.hosts.get(hostname)
+    if host is None:
+      return None
+    return self.networks.get(host.network_id)
+
+  def option(self, hostname, name):
+    """Return all values of an option for a host, in ipplan order."""
+    host = self.hosts.get(hostname)
+    if host is None or host.node_id not in self.options:
+      return []
+    return self.options[host.node_id].get(name, [])
+
+  def vlans_in_domain(self, domain):
+    """Return (network, vlan) for all tagged networks in a domain."""
+    return self.domain_vlans.get(domain, [])
+
+  def meta(self, name):
+    return self.meta_data.get(name)
+
+
+class Snapshot(object):
+  """Memory-mapped compiled ipplan index, see compile_snapshot()."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self._map) < _HEADER.size:
+      raise SnapshotFormatError('%s is truncated' % path)
+    magic, dev, ino, mtime, size, count = _HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC:
+      raise SnapshotFormatError('%s is not a compiled ipplan index' % path)
+    # Stat of the ipplan.db this snapshot was compiled from
+    self.source = (dev, ino, mtime, size)
+    self._sections = {}
+    for i in xrange(count):
+      name, offset, records = _SECTION.unpack_from(
+          self._map, _HEADER.size + i * _SECTION.size)
+      self._sections[name.rstrip('\0')] = (offset, records)
+
+  def _get(self, section, key):
+    """Binary search for key in a section, returns the decoded value."""
+    if section not in self._sections:
+      return None
+    offset, records = self._sections[section]
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    lo, hi = 0, records
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start, end = struct.unpack_from('<II', self._map,
+                                       offset + mid * _OFFSET.size)
+      record_key, _, value = self._map[start:end].partition('\0')
+      if record_key < key:
+        lo = mid + 1
+      elif record_key > key:
+        hi = mid
+      else:
+        return value.decode('utf-8')
+    return None
+
+  def _host_record(self, hostname):
+    value = self._get('host', hostname)
+    return json.loads(value) if value is not None else None
+
+  def lookup_ip(self, ip):
+    return self._get('ip', ip)
+
+  def host(self, hostname):
+    record = self._host_record(hostname)
+    if record is None:
+      return None
+    return Host(record['node_id'], hostname, record['ipv4_addr'],
+                record['ipv6_addr'], record['network_id'])
+
+  def network(self, hostname):
+    record = self._host_record(hostname)
+    if record is None or record['network'] is None:
+      return None
+    return Network(*record['network'])
+
+  def option(self, hostname, name):
+    record = self._host_record(hostname)
+    if record is None:
+      return []
+    return record['options'].get(name, [])
+
+  def vlans_in_domain(self, domain):
+    value = self._get('domain', domain)
+    return [tuple(x) for x in json.loads(value)] if value is not None else []
+
+  def meta(self, name):
+    return self._get('meta', name)
+
+
+def _stat_key(path):
+  st = os.stat(path)
+  return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+
+def _load(path):
+  conn = sqlite3.connect(path, isolation_level=None)
+  try:
+    return Index(conn)
+  finally:
+    conn.close()
+
+
+def _encode(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return str(value)
+
+
+def compile_snapshot(db_path=DB_FILE, output=None):
+  """Compile ipplan.db into a snapshot file, replacing it atomically."""
+  if output is None:
+    output = os.path.splitext(db_path)[0] + '.idx'
+  # Stat before reading, so a database changed while compiling results in a
+  # snapshot that is considered stale
+  source = _stat_key(db_path)
+  idx = _load(db_path)
+
+  sections = {}
+  sections['ip'] = dict(idx.hosts_by_ip)
+  sections['host'] = {}
+  for name, host in idx.hosts.iteritems():
+    network = idx.networks.get(host.network_id)
+    sections['host'][name] = json.dumps({
+        'node_id': host.node_id,
+        'ipv4_addr': host.ipv4_addr,
+        'ipv6_addr': host.ipv6_addr,
+        'network_id': host.network_id,
+        'network': list(network) if network else None,
+        'options': idx.options.get(host.node_id, {}),
+    }, separators=(',', ':'))
+  sections['domain'] = {
+      domain: json.dumps(vlans, separators=(',', ':'))
+      for domain, vlans in idx.domain_vlans.iteritems()}
+  sections['meta'] = dict(idx.meta_data)
+
+  header_size = _HEADER.size + len(sections) * _SECTION.size
+  body = []
+  position = header_size
+  section_headers = []
+  for name in sorted(sections):
+    records = sorted(
+        (_encode(k), _encode(v)) for k, v in sections[name].iteritems()
+        if k is not None and v is not None)
+    table_offset = position
+    position += (len(records) + 1) * _OFFSET.size
+    offsets = []
+    for key, value in records:
+      offsets.append(position)
+      position += len(key) + 1 + len(value)
+    offsets.append(position)
+    section_headers.append(_SECTION.pack(name, table_offset, len(records)))
+    body.append(''.join(_OFFSET.pack(x) for x in offsets))
+    body.extend(key + '\0' + value for key, value in records)
+
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)),
+                             prefix='.ipplan-idx-')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(_HEADER.pack(MAGIC, source[0], source[1], source[2], source[3],
+                           len(sections)))
+      f.write(''.join(section_headers))
+      f.write(''.join(body))
+    os.chmod(tmp, 0644)
+    os.rename(tmp, output)
+  except:
+    os.unlink(tmp)
+    raise
+  return output
+
+
+_index = None
+_index_stat = None
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def _snapshot(path):
+  """Return an opened Snapshot for path, or None if there is none."""
+  try:
+    key = _stat_key(path)
+  except OSError:
+    return None
+  cached = _snapshots.get(path)
+  if cached is not None and cached[0] == key:
+    return cached[1]
+  try:
+    snapshot = Snapshot(path)
+  except (IOError, ValueError, SnapshotFormatError):
+    return None
+  _snapshots[path] = (key, snapshot)
+  return snapshot
+
+
+def index(path=None, snapshot=None):
+  """Return the current view of ipplan.db (DB_FILE if no path is given).
+
+  A compiled snapshot is used if present and compiled from the current
+  database. Otherwise the in-memory Index is returned, rebuilt if ipplan.db
+  has changed. A rebuild creates a new Index and swaps the reference, so
+  callers holding the previous Index keep a consistent view.
+  """
+  global _index, _index_stat
+  if path is None:
+    path = DB_FILE
+  if snapshot is None:
+    snapshot = os.path.splitext(path)[0] + '.idx'
+  key = _stat_key(path)
+  snap = _snapshot(snapshot)
+  if snap is not None and snap.source == key:
+    return snap
+  if _index is not None and _index_stat == (path, key):
+    return _index
+  with _lock:
+    if _index is None or _index_stat != (path, key):
+      _index, _index_stat = _load(path), (path, key)
+    return _index
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Compile ipplan.db into a memory-mappable lookup index')
+  parser.add_argument('--db', default=DB_FILE,
+      help='ipplan database to read (default: %(default)s)')
+  parser.add_argument('--output', default=None,
+      help='Index file to write (default: the database path with .idx)')
+  args = parser.parse_args()
+  print 'Wrote', compile_snapshot(args.db, args.output)
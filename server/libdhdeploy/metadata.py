@@ -1,9 +1,11 @@
 import collections
-import json
 import redis
-import sqlite3
+import threading
 import yaml
 
+from . import ipplan
+from . import store
+
 
 Client = collections.namedtuple('Client', ('hostname', 'ip', 'virtual',
                                            'managed', 'os', 'os_human',
@@ -15,28 +17,47 @@ Network = collections.namedtuple('Network', (
   'dns_domain', 'shortname'))
 
 
+CONFIG_FILE = '/etc/deploy/deploy.yaml'
+
+# Parsed configuration files and the shared Redis client are kept for the
+# lifetime of the process. For CGI this changes nothing, but the WSGI
+# application (deploy.wsgi) serves all requests from one process and would
+# otherwise re-parse the config and reconnect for every request.
+_configs = {}
+_connection = None
+_lock = threading.Lock()
+
+
+def config(path=CONFIG_FILE):
+  with _lock:
+    if path not in _configs:
+      _configs[path] = yaml.safe_load(file(path))
+    return _configs[path]
+
+
 def connection():
-  config = yaml.safe_load(file('/etc/deploy/deploy.yaml'))
-  return redis.StrictRedis(**config['redis'])
+  global _connection
+  if _connection is None:
+    # StrictRedis keeps a thread-safe connection pool, so one client can be
+    # shared by all request threads.
+    client = redis.StrictRedis(**config()['redis'])
+    with _lock:
+      if _connection is None:
+        _connection = client
+  return _connection
 
 
 def _get_os(hostname):
-  conn = sqlite3.connect('/etc/ipplan/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute(
-      'SELECT option.value FROM host '
-      'LEFT JOIN option ON option.node_id = host.node_id '
-      'WHERE option.name = "os" AND host.name = ?', (hostname,))
-  res = c.fetchone()
+  res = ipplan.index().option(hostname, 'os')
   return res[0] if res else None
 
 
 def lookup_ip(ip):
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute('SELECT name FROM host WHERE ipv4_addr_txt = ?', (ip,))
-  res = c.fetchone()
-  return res[0] if res else None
+  return ipplan.index().lookup_ip(ip)
+
+
+# Host record fields returned by find()
+FIND_FIELDS = ('manufacturer', 'installed', 'provisioned')
 
 
 def find(ip, first_if=None):
@@ -51,12 +72,10 @@ def find(ip, first_if=None):
   hostname = lookup_ip(ip)
 
   r = connection()
-  raw = r.get('host-' + hostname)
-  if not raw:
+  metadata = store.get_host(r, hostname, FIND_FIELDS)
+  if not metadata:
     return None, None
 
-  metadata = json.loads(raw)
-
   if 'vmware' in metadata['manufacturer'].lower():
     virtual = True
   if metadata['manufacturer'] == 'QEMU':
@@ -99,15 +118,13 @@ def find(ip, first_if=None):
 def network(client, cm):
   interface = client.interface
   bonded = interface.startswith('bond')
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute('SELECT h.ipv4_addr_txt, ipv4_netmask_txt, ipv4_gateway_txt, '
-            'h.ipv6_addr_txt, ipv6_netmask_txt, ipv6_gateway_txt, vlan '
-            'FROM host h, network n WHERE h.network_id = n.node_id '
-            'AND h.name = ?', (client.hostname, ))
-  res = c.fetchone()
-  if not res:
+  idx = ipplan.index()
+  net = idx.network(client.hostname)
+  if not net:
     return None
+  host = idx.host(client.hostname)
+  res = (host.ipv4_addr, net.ipv4_netmask, net.ipv4_gateway,
+         host.ipv6_addr, net.ipv6_netmask, net.ipv6_gateway, net.vlan)
 
   vlan_interface = interface if client.virtual else '%s.%s' % (
       interface, res[6])
@@ -119,64 +136,39 @@ def network(client, cm):
 
 def installation_network(hostname):
   # Simplified getter for installation network
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute('SELECT h.ipv4_addr_txt, ipv4_netmask_txt, ipv4_gateway_txt, '
-            'vlan FROM host h, network n WHERE h.network_id = n.node_id '
-            'AND h.name = ?', (hostname, ))
-  res = c.fetchone()
-  if not res:
+  idx = ipplan.index()
+  net = idx.network(hostname)
+  if not net:
     return None
 
   shortname, dns_domain = hostname.split('.', 1)
-  return {'v4_address': res[0], 'v4_netmask': res[1], 'v4_gateway': res[2],
-          'vlan': res[3], 'dns_domain': dns_domain, 'shortname': shortname}
+  return {'v4_address': idx.host(hostname).ipv4_addr,
+          'v4_netmask': net.ipv4_netmask, 'v4_gateway': net.ipv4_gateway,
+          'vlan': net.vlan, 'dns_domain': dns_domain, 'shortname': shortname}
 
 
 def update(client, cm):
+  """Write the fields in cm to the host record, other fields are kept."""
   r = connection()
-  r.setex('host-' + client.hostname, 3600, json.dumps(cm))
+  store.update_host(r, client.hostname, cm)
 
 
 def get_deploy(hostname):
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute(
-      'SELECT option.value FROM host '
-      'LEFT JOIN option ON option.node_id = host.node_id '
-      'WHERE option.name = "deploy" AND host.name = ?', (hostname,))
-  res = c.fetchone()
+  res = ipplan.index().option(hostname, 'deploy')
   return res[0].split(',') if res else []
 
 
 def get_vlan(hostname):
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute('SELECT n.name, vlan '
-            'FROM host h, network n WHERE h.network_id = n.node_id '
-            'AND h.name = ?', (hostname, ))
-  res = c.fetchone()
-  return res if res else (None, None)
+  net = ipplan.index().network(hostname)
+  return (net.name, net.vlan) if net else (None, None)
 
 
 def all_vlans_in_same_domain(hostname):
   my_net, _ = get_vlan(hostname)
   my_domain, _ = my_net.split('@', 1)
 
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute('SELECT name, vlan FROM network ORDER BY vlan')
-  for network, vlan in c:
-    if vlan == 0:
-      continue
-    if network.startswith(my_domain + '@'):
-      yield network, vlan
+  for network, vlan in ipplan.index().vlans_in_domain(my_domain):
+    yield network, vlan
 
 def get_current_event():
-  conn = sqlite3.connect('/etc/ipplan/ipplan.db')
-  c = conn.cursor()
-  c.execute(
-    'SELECT value FROM meta_data WHERE name = "current_event"')
-  res = c.fetchone()
-  conn.close()
-  return res[0]
+  return ipplan.index().meta('current_event')
@@ -0,0 +1,613 @@
+"""Key schema for deploy records in Redis.
+
+Records are stored as '<family>-<id>' keys with a TTL. Every family has an
+index sorted set 'index-<family>' with the record keys as members, scored by
+the time the record expires. Writes update the record and its index in one
+MULTI/EXEC transaction, so readers can list a family without KEYS, which
+blocks Redis and walks the whole keyspace. Members that have expired are
+removed lazily when the family is listed.
+
+Host records are hashes and are read and written with the host functions,
+all other families are JSON strings.
+
+Hardware identities are indexed in 'identity-<kind>-<id>' records, see
+set_identities().
+
+The VMs of a manager are kept in one registry hash, see publish_vms().
+
+Work orders are queued per manager and announced on a stream, see
+add_order().
+"""
+import hashlib
+import json
+import redis
+import time
+
+FAMILIES = (
+  'host',
+  'create-vm',
+  'install',
+  'configure-vcenter',
+  'vmware',
+  'bays',
+  'identity',
+)
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class UnknownFamilyError(Error):
+  """The key does not belong to any known record family."""
+
+
+def family(key):
+  """Return the record family of a key, e.g. 'create-vm' for create-vm-X."""
+  for f in FAMILIES:
+    if key.startswith(f + '-'):
+      return f
+  raise UnknownFamilyError('Key %s is not part of any record family' % key)
+
+
+def index_key(family):
+  return 'index-' + family
+
+
+class Script(object):
+  """Lua script run with EVALSHA, loaded into Redis when it is missing.
+
+  Unlike the objects returned by register_script() it is not bound to a
+  client, so the scripts below are created once and called with the client
+  to run them on.
+  """
+
+  def __init__(self, source):
+    self.source = source
+    self.sha = hashlib.sha1(source).hexdigest()
+
+  def __call__(self, r, keys=(), args=()):
+    args = tuple(keys) + tuple(args)
+    try:
+      return r.evalsha(self.sha, len(keys), *args)
+    except redis.exceptions.NoScriptError:
+      r.script_load(self.source)
+      return r.evalsha(self.sha, len(keys), *args)
+
+
+def _setex(pipe, key, ttl, value):
+  pipe.setex(key, ttl, value)
+  pipe.zadd(index_key(family(key)), {key: time.time() + ttl})
+
+
+def setex(r, key, ttl, value):
+  """Write a record with a TTL and add it to its family index."""
+  pipe = r.pipeline()
+  _setex(pipe, key, ttl, value)
+  pipe.execute()
+
+
+def delete(r, *keys):
+  """Delete records and remove them from their family indexes."""
+  if not keys:
+    return
+  pipe = r.pipeline()
+  pipe.delete(*keys)
+  for key in keys:
+    pipe.zrem(index_key(family(key)), key)
+  pipe.execute()
+
+
+def keys(r, family):
+  """Return the keys of all live records in a family."""
+  now = time.time()
+  pipe = r.pipeline()
+  pipe.zremrangebyscore(index_key(family), '-inf', now)
+  pipe.zrangebyscore(index_key(family), now, '+inf')
+  _, members = pipe.execute()
+  return members
+
+
+def items(r, family):
+  """Return (key, value) for all live records in a family.
+
+  Records that are gone even though the index says otherwise (e.g. deleted
+  without going through this module) are dropped from the index.
+  """
+  members = keys(r, family)
+  if not members:
+    return []
+  values = r.mget(members)
+  stale = [k for k, v in zip(members, values) if v is None]
+  if stale:
+    r.zrem(index_key(family), *stale)
+  return [(k, v) for k, v in zip(members, values) if v is not None]
+
+
+# Host records ('host-<fqdn>') are hashes with one JSON encoded value per
+# field, so that state transitions can be done server side by the scripts
+# below without re-encoding the whole record, and readers can fetch only the
+# fields they need.
+HOST_TTL = 3600
+
+# KEYS: host record, host index
+# ARGV: ttl, expiry time, field/value pairs
+_REGISTER_HOST = Script("""
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 2 do
+  redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+""")
+
+# Set some fields of the host, leaving the others as they are, and refresh
+# its TTL.
+# KEYS: host record, host index
+# ARGV: ttl, expiry time, field/value pairs
+_UPDATE_HOST = Script("""
+for i = 3, #ARGV, 2 do
+  redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+""")
+
+# Mark the host installed and attach client and network information, unless
+# already done, and refresh its TTL so it is left to be provisioned. Returns
+# the provisioned field, or nil if there is no record.
+# KEYS: host record, host index
+# ARGV: ttl, expiry time, client, network
+_MARK_INSTALLED = Script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return false
+end
+if redis.call('HGET', KEYS[1], 'installed') ~= 'true' then
+  redis.call('HSET', KEYS[1], 'installed', 'true')
+  redis.call('HSET', KEYS[1], 'client', ARGV[3])
+  redis.call('HSET', KEYS[1], 'network', ARGV[4])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+return redis.call('HGET', KEYS[1], 'provisioned')
+""")
+
+# Mark the host provisioned if it is installed and not yet provisioned.
+# Returns 1 if this call did the transition.
+# KEYS: host record, host index
+# ARGV: ttl, expiry time
+_MARK_PROVISIONED = Script("""
+if redis.call('HGET', KEYS[1], 'installed') ~= 'true' or
+   redis.call('HGET', KEYS[1], 'provisioned') ~= 'false' then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'provisioned', 'true')
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+return 1
+""")
+
+# Set a field of an existing host, keeping its TTL.
+# KEYS: host record
+# ARGV: field, value
+_SET_HOST_FIELD = Script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+""")
+
+
+def host_key(hostname):
+  return 'host-' + hostname
+
+
+def decode_host(fields, values):
+  return {f: json.loads(v) if v is not None else None
+          for f, v in zip(fields, values)}
+
+
+def register_host(r, hostname, data, ttl=HOST_TTL):
+  """Replace the host record with the fields in data."""
+  args = [ttl, time.time() + ttl]
+  for field, value in data.iteritems():
+    args.extend((field, json.dumps(value)))
+  _REGISTER_HOST(
+      r, keys=[host_key(hostname), index_key('host')], args=args)
+
+
+def update_host(r, hostname, data, ttl=HOST_TTL):
+  """Set the fields in data on the host record and refresh its TTL."""
+  args = [ttl, time.time() + ttl]
+  for field, value in data.iteritems():
+    args.extend((field, json.dumps(value)))
+  _UPDATE_HOST(r, keys=[host_key(hostname), index_key('host')], args=args)
+
+
+def get_host(r, hostname, fields=None):
+  """Return the host record (or only the given fields), or None."""
+  key = host_key(hostname)
+  if fields is None:
+    raw = r.hgetall(key)
+    if not raw:
+      return None
+    return decode_host(raw.keys(), raw.values())
+  values = r.hmget(key, fields)
+  if all(v is None for v in values):
+    return None
+  return decode_host(fields, values)
+
+
+def hosts(r, fields):
+  """Return (hostname, fields) for all live host records."""
+  members = keys(r, 'host')
+  if not members:
+    return []
+  pipe = r.pipeline(transaction=False)
+  for key in members:
+    pipe.hmget(key, fields)
+  result = []
+  stale = []
+  for key, values in zip(members, pipe.execute()):
+    if all(v is None for v in values):
+      stale.append(key)
+      continue
+    result.append((key[len('host-'):], decode_host(fields, values)))
+  if stale:
+    r.zrem(index_key('host'), *stale)
+  return result
+
+
+def mark_installed(r, hostname, client, network, ttl=HOST_TTL):
+  """Mark host installed, returns its provisioned state (None if gone).
+
+  Hosts that are waiting to be provisioned are announced on INSTALLED.
+  """
+  provisioned = _MARK_INSTALLED(
+      r, keys=[host_key(hostname), index_key('host')],
+      args=[ttl, time.time() + ttl, json.dumps(client), json.dumps(network)])
+  if provisioned is None:
+    return None
+  provisioned = json.loads(provisioned)
+  if provisioned is False:
+    r.xadd(INSTALLED, {'key': host_key(hostname)}, maxlen=STREAM_MAXLEN)
+  return provisioned
+
+
+def mark_provisioned(r, hostname, ttl=HOST_TTL):
+  """Mark an installed host provisioned, returns False if not applicable."""
+  return bool(_MARK_PROVISIONED(
+      r, keys=[host_key(hostname), index_key('host')],
+      args=[ttl, time.time() + ttl]))
+
+
+def set_host_error(r, hostname, error):
+  """Record an error on a host record, keeping its TTL."""
+  return bool(_SET_HOST_FIELD(
+      r, keys=[host_key(hostname)], args=['error', json.dumps(error)]))
+
+
+def set_host_escrow(r, hostname, state):
+  """Record the escrow state of the secrets of a host, see escrow.py."""
+  return bool(_SET_HOST_FIELD(
+      r, keys=[host_key(hostname)], args=['escrow', json.dumps(state)]))
+
+
+# Identity records map what a machine knows about itself (or what a manager
+# knows about its slots) to where it lives, so that a machine can be resolved
+# with one lookup instead of listing all records of a family:
+#   identity-serial-<serial>        bays, {manager, kind, bay, order}
+#   identity-mac-<mac>              bays booted by MAC, as above
+#   identity-bay-<manager>-<bay>    bays, {manager, kind, bay, serial, order}
+# where order is the key of the install order for the machine. They are kept
+# up to date by the provisiond scrapes and expire if not refreshed.
+IDENTITY_TTL = 600
+
+
+def identity_key(kind, value):
+  if kind == 'mac':
+    value = value.lower()
+  return 'identity-%s-%s' % (kind, value)
+
+
+def set_identities(r, identities, ttl=IDENTITY_TTL):
+  """Write (kind, id, record) identities in one round trip."""
+  if not identities:
+    return
+  pipe = r.pipeline()
+  for kind, value, record in identities:
+    _setex(pipe, identity_key(kind, value), ttl, json.dumps(record))
+  pipe.execute()
+
+
+def get_identity(r, kind, value):
+  """Return the identity record for e.g. a serial, or None."""
+  record = r.get(identity_key(kind, value))
+  return json.loads(record) if record is not None else None
+
+
+# The VMs of a manager are published as one hash, 'vmware-<manager>', mapping
+# the uuid of every VM (as reported by the VM) to {name, fqdn, path, power}.
+# It is in the 'vmware' family index like any other record. Only the VMs that
+# changed are written, along with an increment of 'generation-<registry>'
+# which readers can poll to tell whether anything changed. A manager that is
+# alive but has no changes only refreshes the TTL of its registry and its
+# 'heartbeat-<registry>' key (the time of the last refresh).
+VM_REGISTRY_TTL = 600
+
+# Returns [registry, record] of the first registry with the uuid, or nil.
+# KEYS: vmware family index
+# ARGV: uuid, now
+_FIND_VM = Script("""
+local registries = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[2], '+inf')
+for _, registry in ipairs(registries) do
+  local vm = redis.call('HGET', registry, ARGV[1])
+  if vm then
+    return {registry, vm}
+  end
+end
+return false
+""")
+
+
+def vm_registry_key(manager):
+  return 'vmware-' + manager
+
+
+def _touch_vms(pipe, registry, ttl):
+  pipe.expire(registry, ttl)
+  pipe.setex('heartbeat-' + registry, ttl, time.time())
+  pipe.zadd(index_key('vmware'), {registry: time.time() + ttl})
+
+
+def publish_vms(r, manager, vms, removed=(), replace=False,
+                ttl=VM_REGISTRY_TTL):
+  """Write the changed VMs ({uuid: record}) of a manager to its registry.
+
+  With replace the registry is written from scratch, otherwise the uuids in
+  removed are dropped from it. Returns the new generation.
+  """
+  registry = vm_registry_key(manager)
+  pipe = r.pipeline()
+  if replace:
+    pipe.delete(registry)
+  if vms:
+    pipe.hmset(registry, {uuid: json.dumps(record)
+                          for uuid, record in vms.iteritems()})
+  if removed and not replace:
+    pipe.hdel(registry, *removed)
+  pipe.incr('generation-' + registry)
+  _touch_vms(pipe, registry, ttl)
+  return pipe.execute()[-4]
+
+
+def refresh_vms(r, manager, ttl=VM_REGISTRY_TTL):
+  """Keep the registry of a manager alive without writing it."""
+  pipe = r.pipeline()
+  _touch_vms(pipe, vm_registry_key(manager), ttl)
+  pipe.execute()
+
+
+def vm_generation(r, manager):
+  """Return the generation of the registry of a manager, 0 if none."""
+  return int(r.get('generation-' + vm_registry_key(manager)) or 0)
+
+
+def get_vms(r, manager):
+  """Return the VMs of a manager as {uuid: record}."""
+  return {uuid: json.loads(record) for uuid, record in
+          r.hgetall(vm_registry_key(manager)).iteritems()}
+
+
+def find_vm(r, uuid):
+  """Return the record of a VM by uuid, with its manager, or None."""
+  found = _FIND_VM(
+      r, keys=[index_key('vmware')], args=[uuid.lower(), time.time()])
+  if not found:
+    return None
+  registry, record = found
+  record = json.loads(record)
+  record['manager'] = registry[len('vmware-'):]
+  return record
+
+
+# Work orders (create-vm, install, configure-vcenter) are announced on a
+# stream per manager, 'orders-<manager>', and installed hosts on INSTALLED.
+# Stream entries only carry the key of the record, which stays the source of
+# truth. provisiond reads the streams through a consumer group per manager and
+# acknowledges an entry when the order is done.
+#
+# Every order is also queued in 'queue-<family>-<manager>', a sorted set
+# scored by the time the order may be worked on next. A worker claims due
+# orders, which pushes their score ORDER_LEASE seconds into the future so that
+# other workers for the same manager leave them alone until the lease runs
+# out. Orders that fail are retried with exponential backoff and are given up
+# after MAX_ATTEMPTS, when they are moved to the 'dead-<manager>' list.
+# Orders that cannot be worked on yet, e.g. because the machine has not shown
+# up, are released and claimed again after WAIT_DELAY until they expire.
+INSTALLED = 'events-installed'
+STREAM_MAXLEN = 10000
+ORDER_LEASE = 300
+WAIT_DELAY = 10
+RETRY_DELAY = 10
+RETRY_MAX_DELAY = 600
+MAX_ATTEMPTS = 5
+DEAD_LETTER_MAXLEN = 1000
+
+# Returns key, value, ... of claimed orders. Orders whose record is gone are
+# dropped from the queue.
+# KEYS: queue
+# ARGV: now, lease expiry time, max number of orders
+_CLAIM_ORDERS = Script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'LIMIT', 0, ARGV[3])
+local claimed = {}
+for _, key in ipairs(due) do
+  local value = redis.call('GET', key)
+  if value then
+    redis.call('ZADD', KEYS[1], ARGV[2], key)
+    table.insert(claimed, key)
+    table.insert(claimed, value)
+  else
+    redis.call('ZREM', KEYS[1], key)
+  end
+end
+return claimed
+""")
+
+# Store the updated order, keeping its TTL, and either schedule a retry or
+# move it to the dead letter list.
+# KEYS: order record, queue, dead letter list
+# ARGV: order, time to retry at, dead letter entry (empty to retry),
+#       max length of the dead letter list
+_RETRY_ORDER = Script("""
+local ttl = redis.call('TTL', KEYS[1])
+if ttl == -2 then
+  redis.call('ZREM', KEYS[2], KEYS[1])
+  return 0
+elseif ttl > 0 then
+  redis.call('SETEX', KEYS[1], ttl, ARGV[1])
+else
+  redis.call('SET', KEYS[1], ARGV[1])
+end
+if ARGV[3] == '' then
+  redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+else
+  redis.call('ZREM', KEYS[2], KEYS[1])
+  redis.call('LPUSH', KEYS[3], ARGV[3])
+  redis.call('LTRIM', KEYS[3], 0, ARGV[4] - 1)
+end
+return 1
+""")
+
+
+def orders_key(manager):
+  return 'orders-' + manager
+
+
+def queue_key(family, manager):
+  return 'queue-%s-%s' % (family, manager)
+
+
+def dead_key(manager):
+  return 'dead-' + manager
+
+
+def add_order(r, manager, key, ttl, value):
+  """Write an order record, queue it and announce it to its manager."""
+  pipe = r.pipeline()
+  _setex(pipe, key, ttl, value)
+  pipe.zadd(queue_key(family(key), manager), {key: time.time()})
+  pipe.xadd(orders_key(manager), {'key': key}, maxlen=STREAM_MAXLEN)
+  pipe.execute()
+
+
+def claim_orders(r, manager, family, lease=ORDER_LEASE, limit=100):
+  """Claim due orders of a family, returns (key, order) pairs.
+
+  The orders are leased to the caller for lease seconds, finish them with
+  complete_order() or retry_order() before that.
+  """
+  now = time.time()
+  claimed = _CLAIM_ORDERS(
+      r, keys=[queue_key(family, manager)], args=[now, now + lease, limit])
+  return [(claimed[i], json.loads(claimed[i + 1]))
+          for i in xrange(0, len(claimed), 2)]
+
+
+def complete_order(r, manager, key, delete=True):
+  """Remove a finished order from its queue, and its record unless told not."""
+  pipe = r.pipeline()
+  pipe.zrem(queue_key(family(key), manager), key)
+  if delete:
+    pipe.delete(key)
+    pipe.zrem(index_key(family(key)), key)
+  pipe.execute()
+
+
+def release_order(r, manager, key, delay=WAIT_DELAY):
+  """Give up the lease of an order that cannot be worked on yet.
+
+  It is claimed again after delay seconds, without counting as an attempt.
+  """
+  r.zadd(queue_key(family(key), manager), {key: time.time() + delay}, xx=True)
+
+
+def retry_order(r, manager, key, order, error):
+  """Record a failed attempt at an order and schedule it to be retried.
+
+  Returns True if the order has been given up and moved to the dead letter
+  list. The error and number of attempts are written to the order record.
+  """
+  order = dict(order, error=error, attempts=order.get('attempts', 0) + 1)
+  delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (order['attempts'] - 1))
+  dead = ''
+  if order['attempts'] >= MAX_ATTEMPTS:
+    order['dead'] = True
+    dead = json.dumps({'key': key, 'order': order, 'time': time.time()})
+  _RETRY_ORDER(
+      r, keys=[key, queue_key(family(key), manager), dead_key(manager)],
+      args=[json.dumps(order), time.time() + delay, dead,
+            DEAD_LETTER_MAXLEN])
+  return bool(dead)
+
+
+def create_group(r, stream, group):
+  """Create a consumer group for new entries, unless it already exists."""
+  try:
+    r.xgroup_create(stream, group, id='$', mkstream=True)
+  except redis.ResponseError as e:
+    if not str(e).startswith('BUSYGROUP'):
+      raise
+
+
+def read_group(r, group, consumer, streams, timeout=None, pending=False):
+  """Return (stream, id, key) of entries delivered to a consumer.
+
+  Blocks up to timeout seconds for new entries. With pending set, returns
+  the entries already delivered to the consumer that were never acknowledged
+  instead, e.g. after a restart.
+  """
+  if pending:
+    start, block = '0', None
+  else:
+    start, block = '>', max(1, int(timeout * 1000))
+  response = r.xreadgroup(
+      group, consumer, dict.fromkeys(streams, start), block=block)
+  entries = []
+  for stream, messages in response or []:
+    for entry_id, fields in messages:
+      if not fields:
+        # Trimmed from the stream before it was acknowledged, the order is
+        # picked up by reconciliation if it still exists
+        ack(r, group, stream, entry_id)
+        continue
+      entries.append((stream, entry_id, fields['key']))
+  return entries
+
+
+def claim_stale(r, group, consumer, streams, min_idle, count=100):
+  """Take over entries other consumers have not acknowledged in min_idle.
+
+  Returns (stream, id, key) like read_group().
+  """
+  entries = []
+  for stream in streams:
+    stale = [p['message_id']
+             for p in r.xpending_range(stream, group, '-', '+', count)
+             if p['consumer'] != consumer and
+                p['time_since_delivered'] >= min_idle * 1000]
+    if not stale:
+      continue
+    for entry_id, fields in r.xclaim(
+        stream, group, consumer, int(min_idle * 1000), stale):
+      if not fields:
+        ack(r, group, stream, entry_id)
+        continue
+      entries.append((stream, entry_id, fields['key']))
+  return entries
+
+
+def ack(r, group, stream, *ids):
+  r.xack(stream, group, *ids)
@@ -0,0 +1,27 @@
+"""Templates read by the boot scripts, parsed once per version on disk.
+
+Under deploy.wsgi the scripts would otherwise re-read and re-parse the same
+files on every request. A file is read again only when its mtime, size or
+inode changes, so templates can still be updated in place.
+"""
+import os
+import threading
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def load(path, compile=None):
+  """Return the contents of path, passed through compile if given."""
+  st = os.stat(path)
+  version = (st.st_mtime, st.st_size, st.st_ino)
+  cached = _cache.get((path, compile))
+  if cached is not None and cached[0] == version:
+    return cached[1]
+  with open(path) as f:
+    value = f.read()
+  if compile is not None:
+    value = compile(value)
+  with _lock:
+    _cache[(path, compile)] = (version, value)
+  return value
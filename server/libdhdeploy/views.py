@@ -0,0 +1,84 @@
+"""HTML of the dashboard rows.
+
+Shared by index.py, which renders the whole page, and the dashboard
+aggregator, which sends changed rows to live viewers. Every row has the key
+of its record as id, so that it can be replaced in place.
+"""
+import cgi
+
+# Element id of the table (or block, for bays) a family is shown in
+TABLES = {
+  'host': 'hosts',
+  'create-vm': 'vm-orders',
+  'install': 'install-orders',
+  'vmware': 'vms',
+  'bays': 'bays',
+}
+
+
+def _ttl(row, now):
+  # TTL cells are counted down by the page
+  ttl = int(round(row.expires - now)) if row.expires else -1
+  return '<td class="ttl" data-ttl="%d">%d</td>' % (ttl, ttl)
+
+
+def host(row, now):
+  state_cls = 'info'
+  if row.error:
+    state = 'Error: ' + row.error
+    state_cls = 'danger'
+  elif row.installed:
+    if row.provisioned:
+      state = 'Done'
+      state_cls = ''
+    else:
+      state = 'Waiting for provision'
+  elif row.last_log:
+    state = 'Log: ' + row.last_log
+  else:
+    state = 'Starting installation'
+  # Root password written to Vault, see escrow.py
+  escrow = {'pending': 'Pending', 'done': 'Done', 'failed': 'Failed'}.get(
+      row.escrow, '')
+  return ('<tr id="%s" class="%s"><td>%s</td><td>%s</td><td>%s</td>'
+          '<td>%s</td>%s</tr>') % (
+      row.key, state_cls, cgi.escape(row.name), cgi.escape(row.product or ''),
+      cgi.escape(state), escrow, _ttl(row, now))
+
+
+def vm_order(row, now):
+  return '<tr id="%s"><td>%s</td><td>%s</td>%s</tr>' % (
+      row.key, cgi.escape(row.name), cgi.escape(row.manager), _ttl(row, now))
+
+
+def install_order(row, now):
+  return '<tr id="%s"><td>%s</td><td>%s</td><td>%s</td>%s</tr>' % (
+      row.key, cgi.escape(row.name), cgi.escape(row.manager),
+      cgi.escape('%s' % row.bay), _ttl(row, now))
+
+
+def vm(row, now):
+  return '<tr id="%s"><td>%s</td><td>%s</td></tr>' % (
+      row.key, cgi.escape(row.name), cgi.escape(row.provisioner))
+
+
+def bays(row, now):
+  out = ['<div id="%s">' % row.key]
+  out.append('<h3>%s</h3>' % cgi.escape(row.provisioner))
+  out.append('<table class="table">')
+  for bay in sorted(int(x) for x in row.bays.keys()):
+    props = row.bays[str(bay)]
+    serial = props['serial'] if props else ''
+    out.append('<tr><td>%s</td><td>%s</td></tr>' % (bay, cgi.escape(serial)))
+  out.append('</table>')
+  out.append('</div>')
+  return '\n'.join(out)
+
+
+RENDER = {
+  'host': host,
+  'create-vm': vm_order,
+  'install': install_order,
+  'vmware': vm,
+  'bays': bays,
+}